@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""This script benchmarks format_rst_file.py in check mode, that is without touching the input
+files, over the tutorial sources and over generated documents of increasing size. It reports the
+time spent in each phase of the formatter, and exits with a non-zero status if a phase is slower
+than in a stored baseline."""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import format_rst_file as fmt  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ("parse", "collect", "split", "code_blocks")
+
+#: Phase timings in seconds, per corpus
+Timings = Dict[str, Dict[str, float]]
+
+WORDS = (
+    "spack install package version compiler variant dependency environment module build "
+    "concretize mirror cache view spec hash prefix target architecture provider external"
+).split()
+
+PYTHON_BLOCK = """\
+class Mpileaks{i}(AutotoolsPackage):
+    homepage = "https://github.com/LLNL/mpileaks"
+    url = "https://github.com/LLNL/mpileaks/releases/download/v1.0/mpileaks-1.0.tar.gz"
+
+    version("1.0", sha256="2e34cc4505556d1c1f085758e26f2f8eea0972db9382f051b2dcfb1d7d9e1825")
+
+    depends_on("mpi")
+    depends_on("callpath")
+
+    def configure_args(self):
+        return [f"--with-adept-utils={{self.spec['adept-utils'].prefix}}"]"""
+
+YAML_BLOCK = """\
+spack:
+  specs:
+  - hdf5@1.14.{i}+mpi
+  - zlib-ng
+  view: true
+  concretizer:
+    unify: true"""
+
+JSON_BLOCK = """\
+{{
+  "name": "zlib-ng",
+  "version": "2.{i}.0",
+  "dependencies": []
+}}"""
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(6, 18))
+    return f"{words[0].capitalize()} ``{words[1]}`` {' '.join(words[2:])}."
+
+
+def _paragraph(rng: random.Random, indent: str, sentences: int) -> List[str]:
+    """A paragraph with several sentences per line, which the formatter has to split."""
+    text = " ".join(_sentence(rng) for _ in range(sentences))
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + len(word) > 90:
+            lines.append(indent + line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    return lines + [indent + line, ""]
+
+
+def _table(rng: random.Random, indent: str, rows: int) -> List[str]:
+    """A grid table whose cells contain bullet lists, so that paragraphs sit deep in a table."""
+    width = 40
+    border = f"{indent}+{'-' * width}+{'-' * width}+"
+    lines = [border]
+    for _ in range(rows):
+        cells = [
+            [f"* {' '.join(rng.choices(WORDS, k=3))}."[: width - 2] for _ in range(2)]
+            for _ in range(2)
+        ]
+        for a, b in zip(*cells):
+            lines.append(f"{indent}| {a:<{width - 2}} | {b:<{width - 2}} |")
+        lines.append(border)
+    return lines + [""]
+
+
+def _code_block(i: int, indent: str) -> List[str]:
+    language, block = [("python", PYTHON_BLOCK), ("yaml", YAML_BLOCK), ("json", JSON_BLOCK)][i % 3]
+    lines = [f"{indent}.. code-block:: {language}", ""]
+    lines.extend(f"{indent}   {line}" for line in block.format(i=i).splitlines())
+    return lines + [""]
+
+
+def generate_document(num_lines: int, seed: int = 0, tables: bool = False) -> str:
+    """Generate a reStructuredText document of about ``num_lines`` lines with long paragraphs,
+    code blocks, and tables nested in block quotes and lists. If ``tables`` is True, the document
+    consists mostly of large tables nested deep in lists."""
+    rng = random.Random(seed)
+    lines = ["Synthetic benchmark", "===================", ""]
+    section = 0
+    while len(lines) < num_lines:
+        section += 1
+        title = f"Section {section}"
+        lines.extend([title, "-" * len(title), ""])
+        if not tables:
+            lines.extend(_paragraph(rng, "", rng.randint(5, 30)))
+            lines.extend(_code_block(section, ""))
+        depth = rng.randint(1, 6) if not tables else 12
+        for level in range(depth):
+            lines.extend([f"{'  ' * level}- {_sentence(rng)}"[:100], ""])
+        indent = "  " * depth
+        lines.extend(_paragraph(rng, indent, rng.randint(2, 8)))
+        lines.extend(_table(rng, indent, rng.randint(2, 10) if not tables else 100))
+        if not tables:
+            lines.extend(_code_block(section + 1, indent))
+    return "\n".join(lines) + "\n"
+
+
+def benchmark_file(path: str, timings: Dict[str, float]) -> None:
+    """Run the formatter on ``path`` in check mode, like ``format_rst_file.py --check
+    --no-cache``, and add the wall time of its phases to ``timings``."""
+    _, _, _, stats = fmt._reformat_rst_file_captured(path, fmt.FormatOptions(write=False))
+    for phase, t in stats["seconds"].items():
+        timings[phase] = timings.get(phase, 0.0) + t
+
+
+def run(corpora: List[Tuple[str, List[Tuple[str, str]]]], repeat: int) -> Timings:
+    """Benchmark each corpus, a list of (path, source) pairs, and keep the fastest of ``repeat``
+    runs of each phase. Sources are written to a temporary directory first, since the formatter
+    reads its input from disk."""
+    results: Timings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, docs in corpora:
+            paths = [os.path.join(tmp_dir, path) for path, _ in docs]
+            for path, (_, src) in zip(paths, docs):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(src)
+            best: Dict[str, float] = {}
+            for _ in range(repeat):
+                timings: Dict[str, float] = {}
+                for path in paths:
+                    benchmark_file(path, timings)
+                for phase, t in timings.items():
+                    best[phase] = min(t, best.get(phase, t))
+            results[name] = best
+    return results
+
+
+def report(results: Timings, baseline: Timings) -> None:
+    print(f"{'corpus':<18}" + "".join(f"{phase:>15}" for phase in PHASES) + f"{'total':>15}")
+    for name, timings in results.items():
+        cells = []
+        for phase in (*PHASES, "total"):
+            t = timings.get(phase, 0.0)
+            cell = f"{t * 1000:.1f}ms"
+            if name in baseline and phase in baseline[name]:
+                cell += f" {t / max(baseline[name][phase], 1e-9) - 1:+.0%}"
+            cells.append(f"{cell:>15}")
+        print(f"{name:<18}" + "".join(cells))
+
+
+def regressions(results: Timings, baseline: Timings, tolerance: float, floor: float) -> List[str]:
+    """Phases slower than the baseline by more than ``tolerance``, ignoring phases faster than
+    ``floor`` seconds, which are too noisy to compare."""
+    slower = []
+    for name, timings in results.items():
+        for phase, t in timings.items():
+            base = baseline.get(name, {}).get(phase)
+            if base is not None and t > floor and t > base * (1 + tolerance):
+                slower.append(
+                    f"{name}: {phase} took {t * 1000:.1f}ms, baseline {base * 1000:.1f}ms"
+                )
+    return slower
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[10000, 100000],
+        help="number of lines of each generated document (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--table-sizes",
+        type=int,
+        nargs="*",
+        default=[10000],
+        help="number of lines of each generated table-heavy document (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--small-files",
+        type=int,
+        default=200,
+        help="number of generated documents of 20 lines, where per-file overhead dominates "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="keep the fastest of N runs (default: %(default)s)"
+    )
+    parser.add_argument("--save", metavar="FILE", help="store the timings as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the timings to a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown relative to the baseline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--floor-ms",
+        type=float,
+        default=10.0,
+        help="do not compare phases faster than this (default: %(default)s)",
+    )
+    ns = parser.parse_args(args)
+
+    tutorial = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "*.rst"))):
+        with open(path, "r", encoding="utf-8") as f:
+            tutorial.append((os.path.relpath(path, ROOT), f.read()))
+    corpora = [("tutorial", tutorial)]
+    for size in ns.sizes:
+        corpora.append((f"synthetic-{size}", [(f"synthetic-{size}.rst", generate_document(size))]))
+    if ns.small_files:
+        small = [(f"small-{i}.rst", generate_document(20, seed=i)) for i in range(ns.small_files)]
+        corpora.append(("small-files", small))
+    for size in ns.table_sizes:
+        doc = generate_document(size, tables=True)
+        corpora.append((f"tables-{size}", [(f"tables-{size}.rst", doc)]))
+
+    results = run(corpora, ns.repeat)
+
+    baseline: Timings = {}
+    if ns.compare:
+        with open(ns.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if ns.save:
+        with open(ns.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    slower = regressions(results, baseline, ns.tolerance, ns.floor_ms / 1000)
+    for line in slower:
+        print(f"regression: {line}", file=sys.stderr)
+    sys.exit(1 if slower else 0)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""This script benchmarks the worst-case time of highlighting a single console line with the
+SpecLexer of conf.py. It times adversarial command lines of increasing length, which defeat
+backtracking matchers, and the slowest command lines of the outputs/ directory. It exits with a
+non-zero status if the time per character grows with the length of a line, that is, if
+highlighting is not linear. Like the docs build, it needs Spack in _spack_root."""
+
+import argparse
+import glob
+import importlib.util
+import os
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: The command recognizer that SpecLexer used before it had a linear one, for comparison
+LEGACY_COMMAND = re.compile(
+    r"spack(?:\s+(?:-[eC]\s+\S+|--?\S+))*\s+(?:install|uninstall|spec|load|unload|find|info|"
+    r"list|versions|providers|mark|diff|add|develop)(?: +(?:--?\S+)?)*"
+)
+
+#: Adversarial command lines with ``n`` words
+ADVERSARIAL: Dict[str, Callable[[int], str]] = {
+    "flags": lambda n: "$ spack " + "--flag " * n + "unknown\n",
+    "env-flags": lambda n: "$ spack " + "-e " * n + "unknown\n",
+    "config-env": lambda n: "$ spack " + "-C -e " * (n // 2) + "unknown\n",
+    "long-spec": lambda n: "$ spack install " + " ".join(f"+v{i}" for i in range(n)) + "\n",
+    "long-word": lambda n: "$ spack -" + "x" * n + "\n",
+    "blanks": lambda n: "$ spack" + " " * n + "-e\n",
+}
+
+
+def load_conf():
+    """Load conf.py like Sphinx does, from the root of the tutorial."""
+    os.chdir(ROOT)
+    spec = importlib.util.spec_from_file_location("conf", os.path.join(ROOT, "conf.py"))
+    conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(conf)
+    return conf
+
+
+def best_time(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def corpus_lines() -> List[Tuple[str, str]]:
+    """The command lines of the console outputs in outputs/, with their file names."""
+    lines = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "outputs", "**", "*.out"), recursive=True)):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines.extend((os.path.relpath(path, ROOT), line) for line in f if line.startswith("$"))
+    return lines
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[8, 16, 100, 1000, 10000],
+        help="number of words of the adversarial lines (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="keep the fastest of N runs (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--legacy-max-words",
+        type=int,
+        default=18,
+        help="also time the legacy command regex on adversarial lines of at most this many "
+        "words, 0 to skip (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=3.0,
+        help="allowed ratio between the time per character of the longest and the shortest "
+        "adversarial line (default: %(default)s)",
+    )
+    ns = parser.parse_args(args)
+
+    from pygments import highlight
+
+    conf = load_conf()
+    lexer = conf.SpecLexer()
+    formatter = conf.NoWhitespaceHtmlFormatter()
+
+    def highlight_time(line: str) -> float:
+        return best_time(lambda: highlight(line, lexer, formatter), ns.repeat)
+
+    nonlinear = []
+    print(f"{'line':<12}{'words':>8}{'chars':>9}{'time':>12}{'per char':>12}{'legacy':>12}")
+    for name, make_line in ADVERSARIAL.items():
+        per_char = []
+        for n in ns.sizes:
+            line = make_line(n)
+            t = highlight_time(line)
+            per_char.append(t / len(line))
+            legacy = ""
+            if n <= ns.legacy_max_words:
+                legacy_t = best_time(lambda: LEGACY_COMMAND.match(line, 2), ns.repeat)
+                legacy = f"{legacy_t * 1e3:.3f}ms"
+            print(
+                f"{name:<12}{n:>8}{len(line):>9}{t * 1e3:>10.3f}ms"
+                f"{per_char[-1] * 1e9:>10.0f}ns{legacy:>12}"
+            )
+        if per_char[-1] > per_char[0] * ns.max_growth:
+            nonlinear.append(name)
+
+    lines = corpus_lines()
+    timed = sorted(((highlight_time(line), path, line) for path, line in lines), reverse=True)
+    print(f"\n{len(lines)} command lines in outputs/, slowest:")
+    for t, path, line in timed[:5]:
+        print(f"{t * 1e6:10.1f}us  {path}: {line.strip()[:70]}")
+
+    if nonlinear:
+        print(f"error: highlighting is not linear for: {', '.join(nonlinear)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
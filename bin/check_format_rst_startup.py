@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""This script guards the startup time of format_rst_file.py on files that are already clean. It
+runs the formatter twice under ``python -X importtime`` with a fresh cache, and fails if the
+second run imports any of the heavy formatting modules, or if the modules it imports beyond a
+bare interpreter take longer than the budget."""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+
+FORMATTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "format_rst_file.py")
+HEAVY_MODULES = ("black", "docutils", "ruamel")
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def _import_times(*args: str) -> Dict[str, int]:
+    """Run python with ``-X importtime`` and return the cumulative import time in microseconds of
+    each top-level import."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    times: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        m = IMPORT_TIME.match(line)
+        if m and len(m.group(3)) == 1:
+            times[m.group(4)] = int(m.group(2))
+    return times
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=100.0,
+        help="maximum import time of a run on clean files (default: %(default)s)",
+    )
+    parser.add_argument("files", nargs="+", help="clean reStructuredText files to format")
+    ns = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # --check, so that the runs never rewrite the files
+        formatter = [FORMATTER, "--check", "--cache-dir", cache_dir, *ns.files]
+        subprocess.run([sys.executable, *formatter], capture_output=True)
+        times = _import_times(*formatter)
+
+    interpreter = _import_times("-c", "pass")
+    extra = {name: t for name, t in times.items() if name not in interpreter}
+    total_ms = sum(extra.values()) / 1000
+
+    for name, t in sorted(extra.items(), key=lambda item: item[1], reverse=True):
+        print(f"{t / 1000:8.1f} ms  {name}")
+    print(f"{total_ms:8.1f} ms  total (budget: {ns.budget_ms} ms)")
+
+    heavy = [name for name in times if name.split(".")[0] in HEAVY_MODULES]
+    if heavy:
+        print(f"error: clean files should not import {', '.join(heavy)}", file=sys.stderr)
+        sys.exit(1)
+    if total_ms > ns.budget_ms:
+        print("error: import time exceeds the startup budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
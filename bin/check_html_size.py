@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""This script reports the size of each page of a built HTML tutorial, and how much of it is
+markup of highlighted code blocks, as well as the size of the search index. It exits with a
+non-zero status if a code block has spans the NoWhitespaceHtmlFormatter of conf.py should have
+merged or dropped, or if a page or the search index grew by more than the tolerance relative to a
+stored baseline or has no size in it."""
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HIGHLIGHT_BLOCK = re.compile(r'<div class="highlight"><pre>(.*?)</pre>', re.DOTALL)
+TAG = re.compile(r"<[^>]*>")
+#: Spans for whitespace tokens, which should not be generated at all
+WHITESPACE_SPAN = re.compile(r'<span class="w">')
+#: Two spans of the same token class separated by nothing but whitespace, which should be one
+#: span. Line numbers and emphasized lines have a span per line.
+UNMERGED_SPANS = re.compile(
+    r'<span class="(?!linenos"|hll")([^"]+)">[^<]*</span>\s*<span class="\1">'
+)
+
+#: Bytes per page, and bytes of markup in its highlighted code blocks
+Sizes = Dict[str, Dict[str, int]]
+
+
+def page_sizes(path: str) -> Dict[str, int]:
+    with open(path, "r", encoding="utf-8") as f:
+        page = f.read()
+    tags = [tag for block in HIGHLIGHT_BLOCK.findall(page) for tag in TAG.findall(block)]
+    return {
+        "bytes": len(page.encode()),
+        "tags": len(tags),
+        "markup": sum(len(tag.encode()) for tag in tags),
+    }
+
+
+def span_errors(path: str) -> List[str]:
+    """Spans in the highlighted code blocks of a page that are redundant."""
+    with open(path, "r", encoding="utf-8") as f:
+        blocks = HIGHLIGHT_BLOCK.findall(f.read())
+    errors = []
+    whitespace = sum(len(WHITESPACE_SPAN.findall(block)) for block in blocks)
+    if whitespace:
+        errors.append(f"{whitespace} spans of whitespace")
+    unmerged = sum(len(UNMERGED_SPANS.findall(block)) for block in blocks)
+    if unmerged:
+        errors.append(f"{unmerged} adjacent spans of the same class")
+    return errors
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "html_dir",
+        nargs="?",
+        default=os.path.join(ROOT, "_build", "html"),
+        help="directory of the built HTML pages (default: %(default)s)",
+    )
+    parser.add_argument("--save", metavar="FILE", help="store the page sizes as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the page sizes to a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.01,
+        help="allowed growth of a page relative to the baseline (default: %(default)s)",
+    )
+    ns = parser.parse_args(args)
+
+    pages = sorted(glob.glob(os.path.join(ns.html_dir, "*.html")))
+    if not pages:
+        parser.error(f"no HTML pages in {ns.html_dir}, build them with `make html` first")
+    # the index of the words of all pages, which search pages download
+    pages.extend(glob.glob(os.path.join(ns.html_dir, "searchindex.js")))
+
+    baseline: Sizes = {}
+    if ns.compare:
+        with open(ns.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    sizes: Sizes = {}
+    failures = []
+    print(f"{'page':<40}{'bytes':>10}{'code tags':>11}{'tag bytes':>11}{'baseline':>10}")
+    for path in pages:
+        name = os.path.basename(path)
+        sizes[name] = page_sizes(path)
+        size = sizes[name]["bytes"]
+        change = ""
+        if name in baseline:
+            base = baseline[name]["bytes"]
+            change = f"{size / max(base, 1) - 1:+.1%}"
+            if size > base * (1 + ns.tolerance):
+                failures.append(f"{name}: {size} bytes, baseline {base} bytes")
+        elif ns.compare:
+            # a page missing from the baseline would otherwise never be checked
+            change = "missing"
+            failures.append(f"{name}: not in the baseline, store a new baseline with --save")
+        print(
+            f"{name:<40}{size:>10}{sizes[name]['tags']:>11}{sizes[name]['markup']:>11}"
+            f"{change:>10}"
+        )
+        failures.extend(f"{name}: {error}" for error in span_errors(path))
+
+    total = sum(s["bytes"] for s in sizes.values())
+    markup = sum(s["markup"] for s in sizes.values())
+    print(f"{'total':<40}{total:>10}{'':>11}{markup:>11}")
+
+    if ns.save:
+        with open(ns.save, "w", encoding="utf-8") as f:
+            json.dump(sizes, f, indent=2)
+            f.write("\n")
+
+    for line in failures:
+        print(f"regression: {line}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
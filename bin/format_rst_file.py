@@ -6,20 +6,39 @@
 """This script formats reStructuredText files to ensure one sentence per line and no trailing
 whitespace. It exits with a non-zero status if any files were modified."""
 
-import difflib
+# This script runs as a pre-commit hook on every commit, so heavy modules (docutils, black,
+# ruamel.yaml) are imported lazily, only when a file or code block actually needs work.
+import argparse
+import contextlib
+import functools
+import hashlib
 import io
 import json
 import os
 import re
 import subprocess
 import sys
-from typing import List
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    import multiprocessing.pool
+
+    from docutils import nodes
 
-import black
-from docutils import nodes
-from docutils.core import publish_doctree
-from docutils.parsers.rst import Directive, directives
-from ruamel.yaml import YAML
+#: Inclusive ranges of 1-based line numbers
+LineRanges = List[Tuple[int, int]]
 
 END_OF_SENTENCE = re.compile(
     r"""
@@ -37,34 +56,173 @@ END_OF_SENTENCE = re.compile(
     re.VERBOSE,
 )
 DOCUTILS_SETTING = {"report_level": 5, "raw_enabled": False, "file_insertion_enabled": False}
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "spack-tutorial", "rst"
+)
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_DAEMON_PORT = 45485
+DEFAULT_BLOCK_TIMEOUT = 30.0
+CODE_BLOCK_LANGUAGES = ("python", "yaml", "json")
+HUNK_HEADER = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", re.MULTILINE)
+
+
+class DiskCache:
+    """A size-bounded on-disk cache with one file per entry. Entries are evicted least recently
+    used first, where a cache hit counts as a use. Concurrent processes may share a cache: each
+    entry is written to a temporary file and atomically renamed into place."""
+
+    def __init__(self, root: str, max_entries: int = DEFAULT_CACHE_SIZE) -> None:
+        self.root = root
+        self.max_entries = max_entries
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return value
 
+    def put(self, key: str, value: str) -> None:
+        path = self._path(key)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        except OSError:
+            pass
+
+    def prune(self) -> None:
+        """Remove the least recently used entries until at most ``max_entries`` remain."""
+        try:
+            entries = [e for e in os.scandir(self.root) if not e.name.endswith(".tmp")]
+        except OSError:
+            return
+        if len(entries) <= self.max_entries:
+            return
+        # Entries may vanish while another process prunes or clears the cache.
+        mtimes = []
+        for entry in entries:
+            with contextlib.suppress(OSError):
+                mtimes.append((entry.stat().st_mtime, entry))
+        mtimes.sort(key=lambda m: m[0])
+        for _, entry in mtimes[: len(mtimes) - self.max_entries]:
+            with contextlib.suppress(OSError):
+                os.unlink(entry.path)
+
+    def clear(self) -> None:
+        with contextlib.suppress(OSError):
+            for entry in os.scandir(self.root):
+                with contextlib.suppress(OSError):
+                    os.unlink(entry.path)
+
+
+class FileStats:
+    """Timings in seconds and counters of formatting a single file, reported by ``--stats``."""
+
+    def __init__(self, path: str = "") -> None:
+        self.path = path
+        self.cached = False
+        self.seconds: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def time(self, key: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(key, time.perf_counter() - start)
 
-class SphinxCodeBlock(Directive):
-    """Defines a code-block directive with the options Sphinx supports."""
+    def add_time(self, key: str, seconds: float) -> None:
+        self.seconds[key] = self.seconds.get(key, 0.0) + seconds
 
-    has_content = True
-    optional_arguments = 1  # language
-    required_arguments = 0
-    option_spec = {
-        "force": directives.unchanged,
-        "linenos": directives.unchanged,
-        "dedent": directives.unchanged,
-        "lineno-start": directives.unchanged,
-        "emphasize-lines": directives.unchanged,
-        "caption": directives.unchanged,
-        "class": directives.unchanged,
-        "name": directives.unchanged,
-    }
+    def count(self, key: str, n: int = 1) -> None:
+        self.counts[key] = self.counts.get(key, 0) + n
 
-    def run(self) -> List[nodes.Node]:
-        # Produce a literal block with block.attributes["language"] set.
-        language = self.arguments[0] if self.arguments else "python"
-        literal = nodes.literal_block("\n".join(self.content), "\n".join(self.content))
-        literal["language"] = language
-        return [literal]
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "cached": self.cached,
+            "seconds": self.seconds,
+            "counts": self.counts,
+        }
 
 
-directives.register_directive("code-block", SphinxCodeBlock)
+@functools.lru_cache(maxsize=None)
+def _register_code_block_directive() -> None:
+    """Register a code-block directive with docutils. Deferred to the first parse, because
+    defining it requires importing docutils."""
+    from docutils import nodes
+    from docutils.parsers.rst import Directive, directives
+
+    class SphinxCodeBlock(Directive):
+        """Defines a code-block directive with the options Sphinx supports."""
+
+        has_content = True
+        optional_arguments = 1  # language
+        required_arguments = 0
+        option_spec = {
+            "force": directives.unchanged,
+            "linenos": directives.unchanged,
+            "dedent": directives.unchanged,
+            "lineno-start": directives.unchanged,
+            "emphasize-lines": directives.unchanged,
+            "caption": directives.unchanged,
+            "class": directives.unchanged,
+            "name": directives.unchanged,
+        }
+
+        def run(self) -> List[nodes.Node]:
+            # Produce a literal block with block.attributes["language"] set.
+            language = self.arguments[0] if self.arguments else "python"
+            literal = nodes.literal_block("\n".join(self.content), "\n".join(self.content))
+            literal["language"] = language
+            # Directive nodes have no reliable line number, so record where content starts.
+            literal["content_lineno"] = self.content_offset + 1
+            return [literal]
+
+    directives.register_directive("code-block", SphinxCodeBlock)
+
+
+class RstParser:
+    """Parses reStructuredText documents. ``docutils.core.publish_doctree`` builds an option
+    parser, a settings object and a reader/parser pipeline for every document, which costs more
+    than parsing a small file. This builds the settings and the parser once and reuses them.
+    Only the parser runs, not the reader's transforms, which do not move paragraphs or literal
+    blocks."""
+
+    def __init__(self) -> None:
+        from docutils.frontend import get_default_settings
+        from docutils.parsers.rst import Parser
+
+        _register_code_block_directive()
+        self.parser = Parser()
+        self.settings = get_default_settings(Parser)
+        for key, value in DOCUTILS_SETTING.items():
+            setattr(self.settings, key, value)
+
+    def parse(self, src: str) -> "nodes.document":
+        from docutils.utils import new_document
+
+        document = new_document("<string>", self.settings)
+        self.parser.parse(src, document)
+        return document
+
+
+@functools.lru_cache(maxsize=None)
+def _rst_parser() -> RstParser:
+    return RstParser()
+
+
+def _parse_rst(src: str) -> "nodes.document":
+    return _rst_parser().parse(src)
 
 
 class ParagraphInfo:
@@ -80,46 +238,306 @@ class ParagraphInfo:
         self.end_lineno = line + len(self.lines) - 1
 
 
-def _is_node_in_table(node: nodes.Node) -> bool:
-    """Check if a node is inside a table by walking up the parent chain."""
-    while node.parent:
-        node = node.parent
-        if isinstance(node, nodes.table):
-            return True
-    return False
+def _changed_lines(path: str, rev: str) -> Optional[LineRanges]:
+    """Return the line ranges of ``path`` that differ from revision ``rev``, according to git.
+    Returns None if the file is not tracked, meaning the whole file should be considered."""
+    cwd, name = os.path.split(os.path.abspath(path))
+    tracked = subprocess.run(
+        ["git", "ls-files", "--error-unmatch", "--", name],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if tracked.returncode != 0:
+        return None
+    diff = subprocess.run(
+        ["git", "--no-pager", "diff", "--no-color", "--no-ext-diff", "-U0", rev, "--", name],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    ranges: LineRanges = []
+    for m in HUNK_HEADER.finditer(diff):
+        start, count = int(m.group(1)), int(m.group(2) or 1)
+        # A pure deletion after line ``start`` may join the lines around it.
+        ranges.append((start, start + count - 1) if count else (start, start + 1))
+    return ranges
 
 
-def _format_code_blocks(document: nodes.document, path: str) -> None:
-    """Try to parse and format Python, YAML, and JSON code blocks. This does *not* update the
-    sources, but merely warns. That's because not all code examples are meant to be valid."""
-    for code_block in document.findall(nodes.literal_block):
-        language = code_block.attributes.get("language", "")
-        if language not in ("python", "yaml", "json"):
-            continue
-        original = code_block.astext()
-        line = code_block.line if code_block.line else 0
+def _overlaps(ranges: Optional[LineRanges], first: int, last: int) -> bool:
+    return ranges is None or any(start <= last and first <= end for start, end in ranges)
 
-        try:
+
+def _literal_block_lines(code_block: "nodes.literal_block") -> Optional[Tuple[int, int]]:
+    """Return the first and last source line of a literal block, if known."""
+    first = code_block.get("content_lineno", code_block.line)
+    if first is None:
+        return None
+    return first, first + max(len(code_block.astext().splitlines()), 1) - 1
+
+
+@contextlib.contextmanager
+def _time_limit(seconds: Optional[float]) -> Iterator[None]:
+    """Raise TimeoutError in the body if it runs for longer than ``seconds``. The limit is only
+    enforced in the main thread, on platforms with ``signal.setitimer``."""
+    import signal
+    import threading
+
+    if (
+        not seconds
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def expired(signum: int, frame: Any) -> None:
+        raise TimeoutError
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+#: Options of the formatter of each language of code blocks, part of the key of cached blocks
+CODE_BLOCK_OPTIONS: Dict[str, Dict[str, Any]] = {
+    "python": {"line_length": 99},
+    # do not wrap lines, and do not force particular quotes
+    "yaml": {"width": 10000, "preserve_quotes": True},
+    "json": {"indent": 2},
+}
+
+
+def _format_code_block(
+    language: str, original: str, timeout: Optional[float] = None
+) -> Tuple[bool, str]:
+    """Format a single code block. Returns ``(True, formatted)`` on success and ``(False,
+    error)`` if the block cannot be parsed. Raises TimeoutError after ``timeout`` seconds."""
+    try:
+        with _time_limit(timeout):
             if language == "python":
-                formatted = black.format_str(original, mode=black.FileMode(line_length=99))
+                import black
+
+                mode = black.FileMode(**CODE_BLOCK_OPTIONS["python"])
+                return True, black.format_str(original, mode=mode)
             elif language == "yaml":
+                from ruamel.yaml import YAML
+
                 yaml = YAML(pure=True)
-                yaml.width = 10000  # do not wrap lines
-                yaml.preserve_quotes = True  # do not force particular quotes
+                for option, value in CODE_BLOCK_OPTIONS["yaml"].items():
+                    setattr(yaml, option, value)
                 buf = io.BytesIO()
                 yaml.dump(yaml.load(original), buf)
-                formatted = buf.getvalue().decode("utf-8")
+                return True, buf.getvalue().decode("utf-8")
             elif language == "json":
-                formatted = json.dumps(json.loads(original), indent=2)
+                return True, json.dumps(json.loads(original), **CODE_BLOCK_OPTIONS["json"])
             else:
                 assert False
-        except Exception as e:
+    except TimeoutError:
+        raise
+    except Exception as e:
+        return False, str(e)
+
+
+@functools.lru_cache(maxsize=None)
+def _code_block_tool_version(language: str) -> str:
+    import importlib.metadata
+
+    if language == "python":
+        return f"black {importlib.metadata.version('black')}"
+    elif language == "yaml":
+        return f"ruamel.yaml {importlib.metadata.version('ruamel.yaml')}"
+    return f"json {sys.version_info[:2]}"
+
+
+def _code_block_key(language: str, original: str) -> str:
+    parts = (
+        language,
+        _code_block_tool_version(language),
+        repr(sorted(CODE_BLOCK_OPTIONS[language].items())),
+        original,
+    )
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def _check_code_block(
+    language: str, original: str, timeout: Optional[float]
+) -> Tuple[Optional[Tuple[bool, str]], float]:
+    """The unit of work of ``CodeBlockChecker``: the result of ``_format_code_block``, or None if
+    it timed out, and the time it took."""
+    start = time.perf_counter()
+    try:
+        result: Optional[Tuple[bool, str]] = _format_code_block(language, original, timeout)
+    except TimeoutError:
+        result = None
+    return result, time.perf_counter() - start
+
+
+class CodeBlockChecker:
+    """Checks code blocks with black, ruamel.yaml, and json. Blocks that are not in ``cache`` are
+    checked on a pool of ``jobs`` worker processes, created on first use, while the caller goes
+    on to split sentences; with ``jobs=None`` they are checked in-process. A block that takes
+    longer than ``timeout`` seconds is reported as failed, so that a pathological snippet cannot
+    stall the formatter."""
+
+    def __init__(
+        self,
+        cache: Optional[DiskCache] = None,
+        jobs: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.cache = cache
+        self.jobs = jobs
+        self.timeout = timeout
+        self._pool: Optional["multiprocessing.pool.Pool"] = None
+
+    def _get_pool(self) -> "multiprocessing.pool.Pool":
+        if self._pool is None:
+            import multiprocessing
+
+            self._pool = multiprocessing.Pool(self.jobs)
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def start(
+        self, code_blocks: List["nodes.literal_block"], stats: FileStats
+    ) -> Callable[[], List[Tuple[bool, str]]]:
+        """Start checking ``code_blocks``. Returns a function that waits for the results, one
+        ``(ok, formatted or error)`` pair per block, in the order of ``code_blocks``."""
+        checked: Dict[int, Tuple[bool, str]] = {}
+        jobs: Dict[int, Tuple[str, Optional[str], Any]] = {}
+        for i, code_block in enumerate(code_blocks):
+            language = code_block["language"]
+            original = code_block.astext()
+            stats.count(f"code_blocks.{language}")
+            key = None
+            if self.cache is not None:
+                key = _code_block_key(language, original)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    stats.count("block_cache_hits")
+                    ok, text = json.loads(cached)
+                    checked[i] = ok, text
+                    continue
+            args = (language, original, self.timeout)
+            if self.jobs is None:
+                jobs[i] = language, key, _check_code_block(*args)
+            else:
+                jobs[i] = language, key, self._get_pool().apply_async(_check_code_block, args)
+
+        # Workers time out blocks themselves, but a signal cannot interrupt every C extension,
+        # so the pool also gets a deadline for the whole file, after which it is replaced.
+        deadline = None
+        if self.timeout and self.jobs is not None:
+            rounds = -(-len(jobs) // self.jobs)
+            deadline = time.monotonic() + self.timeout * rounds + 1.0
+
+        def wait() -> List[Tuple[bool, str]]:
+            stuck = False
+            for i, (language, key, job) in jobs.items():
+                if self.jobs is None:
+                    result, seconds = job
+                else:
+                    import multiprocessing
+
+                    remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    try:
+                        result, seconds = job.get(remaining)
+                    except multiprocessing.TimeoutError:
+                        result, seconds, stuck = None, 0.0, True
+                stats.add_time(_code_block_tool_version(language).split()[0], seconds)
+                if result is None:
+                    stats.count("block_timeouts")
+                    result = False, f"timed out after {self.timeout:g} seconds"
+                elif self.cache is not None and key is not None:
+                    self.cache.put(key, json.dumps(result))
+                checked[i] = result
+            if stuck:
+                self.close()
+            return [checked[i] for i in range(len(code_blocks))]
+
+        return wait
+
+
+class DocumentNodes(NamedTuple):
+    """The nodes of a document that the formatter works on, ordered from bottom to top."""
+
+    #: Paragraphs outside of tables
+    paragraphs: List[ParagraphInfo]
+    #: Literal blocks in one of ``CODE_BLOCK_LANGUAGES``
+    code_blocks: List["nodes.literal_block"]
+
+
+def _collect_nodes(
+    document: "nodes.document",
+    changed: Optional[LineRanges] = None,
+    stats: Optional[FileStats] = None,
+) -> DocumentNodes:
+    """Collect the paragraphs and code blocks to format in a single pass over the document. If
+    ``changed`` is given, only nodes overlapping those line ranges are collected."""
+    from docutils import nodes
+
+    stats = stats or FileStats()
+    paragraphs: List[ParagraphInfo] = []
+    code_blocks: List[nodes.literal_block] = []
+
+    # Depth-first traversal visiting children last to first, so that nodes come out in reverse
+    # document order, which is what we need to work from bottom to top without sorting. Table
+    # membership is passed down instead of looked up from the parent chain of every paragraph.
+    stack: List[Tuple[nodes.Node, bool]] = [(document, False)]
+    while stack:
+        node, in_table = stack.pop()
+        if isinstance(node, nodes.paragraph):
+            if node.line is None or not node.rawsource:
+                continue
+            if in_table:
+                stats.count("paragraphs_in_tables")
+                continue
+            p = ParagraphInfo(line=node.line, src=node.rawsource)
+            if _overlaps(changed, p.lineno, p.end_lineno):
+                paragraphs.append(p)
+        elif isinstance(node, nodes.literal_block):
+            if node.get("language", "") not in CODE_BLOCK_LANGUAGES:
+                continue
+            span = _literal_block_lines(node)
+            if span is None or _overlaps(changed, *span):
+                code_blocks.append(node)
+        else:
+            in_table = in_table or isinstance(node, nodes.table)
+            stack.extend((child, in_table) for child in node.children)
+
+    stats.count("paragraphs", len(paragraphs))
+    return DocumentNodes(paragraphs, code_blocks)
+
+
+def _report_code_blocks(
+    code_blocks: List["nodes.literal_block"], results: List[Tuple[bool, str]], path: str
+) -> None:
+    """Warn about code blocks, given from top to bottom, that failed to parse or that are not
+    formatted, according to the ``results`` of ``CodeBlockChecker``."""
+    for code_block, (ok, formatted) in zip(code_blocks, results):
+        original = code_block.astext()
+        line = code_block.line if code_block.line else 0
+        if not ok:
             print(
-                f"{path}:{line}: formatting failed: {e}: {original!r}", flush=True, file=sys.stderr
+                f"{path}:{line}: formatting failed: {formatted}: {original!r}",
+                flush=True,
+                file=sys.stderr,
             )
             continue
         if formatted == original:
             continue
+        import difflib
+
         diff = "\n".join(
             difflib.unified_diff(
                 original.splitlines(),
@@ -133,18 +551,20 @@ def _format_code_blocks(document: nodes.document, path: str) -> None:
             print(diff, flush=True, file=sys.stderr)
 
 
-def _format_paragraphs(document: nodes.document, path: str, src_lines: List[str]) -> bool:
-    """Format paragraphs in the document. Returns True if ``src_lines`` was modified."""
+#: Joins the paragraphs of a document for sentence splitting. It is not whitespace, so no match of
+#: END_OF_SENTENCE can span two paragraphs. Documents that contain it are split per paragraph.
+PARAGRAPH_SEPARATOR = "\0"
 
-    paragraphs = [
-        ParagraphInfo(line=p.line, src=p.rawsource)
-        for p in document.findall(nodes.paragraph)
-        if p.line is not None and p.rawsource and not _is_node_in_table(p)
-    ]
 
-    # Work from bottom to top to avoid messing up line numbers
-    paragraphs.sort(key=lambda p: p.lineno, reverse=True)
-    modified = False
+def _split_sentences(paragraphs: List[ParagraphInfo], path: str, src_lines: List[str]) -> bool:
+    """Put each sentence of the given paragraphs on its own line. The paragraphs must be ordered
+    from bottom to top. Returns True if ``src_lines`` was modified.
+
+    Sentences of all paragraphs are split by a single regex pass over their joined text, and the
+    output is rebuilt in one pass over the source lines, so the cost is linear in the size of
+    the document."""
+    paragraphs = paragraphs[::-1]
+    prefixes: List[Tuple[str, str]] = []
 
     for p in paragraphs:
         # docutils does not give us the column offset, so we'll find it ourselves.
@@ -158,45 +578,476 @@ def _format_paragraphs(document: nodes.document, path: str, src_lines: List[str]
             line_rhs = src_lines[p.lineno - 1 + i].rstrip()  # docutils trims trailing whitespace
             assert line_lhs == line_rhs, f"{path}:{p.lineno + i}: rst parsing error."
 
-        # Replace current newlines with whitespace, and then split sentences.
-        new_paragraph_src = END_OF_SENTENCE.sub(r"\1\n", p.src.replace("\n", " "))
+        prefixes.append((prefix(0), prefix(1)))
+
+    # Replace current newlines with whitespace, and then split sentences. The n-th part of the
+    # result maps back to the n-th paragraph, and through it to its source lines.
+    srcs = [p.src.replace("\n", " ") for p in paragraphs]
+    if any(PARAGRAPH_SEPARATOR in src for src in srcs):
+        # The separator occurs in the text, so splitting the joined text would not give back the
+        # paragraphs. Split each paragraph on its own.
+        new_paragraph_srcs = [END_OF_SENTENCE.sub(r"\1\n", src) for src in srcs]
+    else:
+        joined = PARAGRAPH_SEPARATOR.join(srcs)
+        new_paragraph_srcs = END_OF_SENTENCE.sub(r"\1\n", joined).split(PARAGRAPH_SEPARATOR)
+
+    modified = False
+    new_src_lines: List[str] = []
+    next_line = 0  # index of the first source line not yet copied to the output
+    for p, (first, rest), new_paragraph_src in zip(paragraphs, prefixes, new_paragraph_srcs):
         new_paragraph_lines = [
-            f"{prefix(i)}{line.lstrip()}" for i, line in enumerate(new_paragraph_src.splitlines())
+            f"{rest if i > 0 else first}{line.lstrip()}"
+            for i, line in enumerate(new_paragraph_src.splitlines())
         ]
-
-        if new_paragraph_lines != src_lines[p.lineno - 1 : p.end_lineno]:
+        new_src_lines.extend(src_lines[next_line : p.lineno - 1])
+        new_src_lines.extend(new_paragraph_lines)
+        next_line = p.end_lineno
+        if not modified and new_paragraph_lines != src_lines[p.lineno - 1 : p.end_lineno]:
             modified = True
-            src_lines[p.lineno - 1 : p.end_lineno] = new_paragraph_lines
 
+    if modified:
+        new_src_lines.extend(src_lines[next_line:])
+        src_lines[:] = new_src_lines
     return modified
 
 
-def reformat_rst_file(path: str) -> bool:
-    """Reformat a reStructuredText file "in-place". Returns True if modified, False otherwise."""
+def format_rst_source(
+    src: str,
+    path: str,
+    changed: Optional[LineRanges] = None,
+    checker: Optional[CodeBlockChecker] = None,
+    stats: Optional[FileStats] = None,
+) -> Optional[str]:
+    """Format reStructuredText source read from ``path``. Returns the formatted source, or None
+    if it is already formatted. Code block diagnostics are printed to stderr."""
+    stats = stats or FileStats(path)
+    src_lines = src.splitlines()
+    with stats.time("parse"):
+        document = _parse_rst(src)
+
+    with stats.time("collect"):
+        collected = _collect_nodes(document, changed, stats)
+
+    # Code blocks are checked while sentences are split, and reported once both are done.
+    code_blocks = collected.code_blocks[::-1]
+    with stats.time("code_blocks"):
+        wait = (checker or CodeBlockChecker()).start(code_blocks, stats)
+
+    with stats.time("split"):
+        modified = _split_sentences(collected.paragraphs, path, src_lines)
+
+    with stats.time("code_blocks"):
+        _report_code_blocks(code_blocks, wait(), path)
+
+    if not modified:
+        return None
+    return "\n".join(src_lines) + "\n"
+
+
+class FormatOptions(NamedTuple):
+    """Options that apply to every file in a run."""
+
+    #: Cache of files known to be clean
+    cache: Optional[DiskCache] = None
+    #: Cache of code block checks
+    block_cache: Optional[DiskCache] = None
+    #: Number of processes that check the code blocks of a file, or None to check in-process
+    block_jobs: Optional[int] = None
+    #: Seconds after which checking a code block fails
+    block_timeout: Optional[float] = None
+    #: Only consider lines changed since this git revision
+    since: Optional[str] = None
+    #: Port of a formatter daemon on localhost to try before formatting in-process
+    daemon_port: Optional[int] = None
+    #: Whether to write formatted files back to disk
+    write: bool = True
+    #: Whether to print a unified diff of each file that needs formatting
+    diff: bool = False
+
+
+@functools.lru_cache(maxsize=None)
+def _checker(
+    cache_root: Optional[str], cache_size: int, jobs: Optional[int], timeout: Optional[float]
+) -> CodeBlockChecker:
+    cache = DiskCache(cache_root, cache_size) if cache_root is not None else None
+    return CodeBlockChecker(cache, jobs, timeout)
+
+
+def _code_block_checker(options: FormatOptions) -> CodeBlockChecker:
+    """The code block checker of ``options``. There is one per process, so that its worker pool
+    is reused across files, also when options are passed to a worker process."""
+    cache = options.block_cache
+    return _checker(
+        cache.root if cache is not None else None,
+        cache.max_entries if cache is not None else DEFAULT_CACHE_SIZE,
+        options.block_jobs,
+        options.block_timeout,
+    )
+
+
+def reformat_rst_file(
+    path: str, options: FormatOptions = FormatOptions(), stats: Optional[FileStats] = None
+) -> bool:
+    """Reformat a reStructuredText file "in-place". Returns True if the file needs formatting,
+    False otherwise. If ``options.since`` is a git revision, only paragraphs and code blocks
+    that overlap lines changed since that revision are considered. With ``options.write`` unset
+    the file is left untouched."""
+    stats = stats or FileStats(path)
+    changed = _changed_lines(path, options.since) if options.since is not None else None
+    if changed == []:
+        return False
+
     with open(path, "r", encoding="utf-8") as f:
         src = f.read()
 
-    src_lines = src.splitlines()
-    document: nodes.document = publish_doctree(src, settings_overrides=DOCUTILS_SETTING)
+    if options.daemon_port is None:
+        formatted = format_rst_source(src, path, changed, _code_block_checker(options), stats)
+    else:
+        try:
+            formatted = _format_with_daemon(options.daemon_port, src, path, changed, stats)
+            stats.count("daemon")
+        except (OSError, ValueError, KeyError):
+            formatted = format_rst_source(src, path, changed, _code_block_checker(options), stats)
+    if formatted is None:
+        return False
 
-    _format_code_blocks(document, path)
+    if options.diff:
+        import difflib
 
-    if not _format_paragraphs(document, path, src_lines):
-        return False
+        diff = difflib.unified_diff(
+            src.splitlines(keepends=True),
+            formatted.splitlines(keepends=True),
+            fromfile=path,
+            tofile=path,
+        )
+        sys.stdout.writelines(diff)
+        sys.stdout.flush()
+
+    if not options.write:
+        if not options.diff:
+            print(f"Would fix reStructuredText formatting: {path}", flush=True)
+        return True
 
-    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
-        f.write("\n".join(src_lines))
-        f.write("\n")
+    with stats.time("write"), open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        stats.count("bytes_written", f.write(formatted))
     os.rename(f"{path}.tmp", path)
     print(f"Fixed reStructuredText formatting: {path}", flush=True)
     return True
 
 
-def main(*files: str) -> None:
+def _format_with_daemon(
+    port: int, src: str, path: str, changed: Optional[LineRanges], stats: FileStats
+) -> Optional[str]:
+    """Ask the formatter daemon on localhost to format ``src``. Raises OSError if the daemon is
+    not running, fails, or runs another version of the formatter, and ValueError or KeyError if
+    something else answers on the port, so that the caller can fall back to formatting
+    in-process."""
+    import urllib.request
+
+    salt = hashlib.sha256(_cache_salt()).hexdigest()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/",
+        data=json.dumps({"source": src, "path": path, "changed": changed, "salt": salt}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        result = json.loads(response.read())
+    # Daemons that predate the salt check do not echo it.
+    if result["salt"] != salt:
+        raise ValueError("the formatter daemon runs another version of the formatter")
+    sys.stderr.write(result["diagnostics"])
+    sys.stderr.flush()
+    if result.get("block_timeouts"):
+        stats.count("block_timeouts", result["block_timeouts"])
+    return result["formatted"]
+
+
+def serve(port: int, checker: CodeBlockChecker) -> None:
+    """Run a formatter daemon on localhost that keeps docutils and black loaded between
+    requests. It accepts POST requests with a JSON object ``{"source": str, "path": str,
+    "changed": [[first, last], ...] | null, "salt": str}`` and responds with ``{"formatted": str
+    | null, "diagnostics": str, "block_timeouts": int, "salt": str}``, where ``formatted`` is null
+    if the source is already formatted. ``salt`` is the hash of ``_cache_salt()``; requests from
+    another version of the formatter are rejected with 409, so that clients do not cache this
+    daemon's results under their own salt."""
+    import http.server
+
+    import black  # noqa: F401
+
+    _parse_rst("Warm up.\n")
+    # Computed now, so that a later change to this file does not change the daemon's salt.
+    salt = hashlib.sha256(_cache_salt()).hexdigest()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if request.get("salt") != salt:
+                self.send_error(409, explain="The formatter daemon runs another version.")
+                return
+            changed = request.get("changed")
+            err = io.StringIO()
+            stats = FileStats(request["path"])
+            try:
+                with contextlib.redirect_stderr(err):
+                    formatted = format_rst_source(
+                        request["source"],
+                        request["path"],
+                        [tuple(r) for r in changed] if changed is not None else None,
+                        checker,
+                        stats,
+                    )
+            except Exception as e:
+                self.send_error(500, explain=str(e))
+                return
+            response = {
+                "formatted": formatted,
+                "diagnostics": err.getvalue(),
+                "block_timeouts": stats.counts.get("block_timeouts", 0),
+                "salt": salt,
+            }
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    # Requests are handled one at a time: docutils' directive registry is global state.
+    with http.server.HTTPServer(("127.0.0.1", port), Handler) as server:
+        print(f"Formatting reStructuredText on http://127.0.0.1:{port}/", flush=True)
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+    checker.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _cache_salt() -> bytes:
+    """Everything besides the file contents that determines the formatter's output. Versions are
+    read from package metadata, so computing the salt does not import any of the packages."""
+    import importlib.metadata
+
+    parts = [importlib.metadata.version(pkg) for pkg in ("docutils", "black", "ruamel.yaml")]
+    parts.append(END_OF_SENTENCE.pattern)
+    parts.append(repr(sorted(DOCUTILS_SETTING.items())))
+    with open(__file__, "rb") as f:
+        parts.append(hashlib.sha256(f.read()).hexdigest())
+    return "\0".join(parts).encode()
+
+
+def _cache_key(path: str, content: bytes) -> str:
+    # The path is part of the key because cached diagnostics refer to it.
+    return hashlib.sha256(b"\0".join((_cache_salt(), path.encode(), content))).hexdigest()
+
+
+def _reformat_rst_file_captured(
+    path: str, options: FormatOptions = FormatOptions()
+) -> Tuple[bool, str, str, Dict[str, Any]]:
+    """Run ``reformat_rst_file`` with stdout and stderr captured, so that a worker process can
+    hand its output back to the parent, which prints it in a deterministic order.
+
+    If ``options.cache`` is given, files whose contents are known to be clean are skipped, and the
+    diagnostics recorded for them on the run that found them clean are returned instead. The
+    last element of the result are the file's statistics, see ``FileStats``."""
+    stats = FileStats(path)
+    with stats.time("total"):
+        cache = options.cache
+        key = None
+        if cache is not None:
+            with open(path, "rb") as f:
+                key = _cache_key(path, f.read())
+            diagnostics = cache.get(key)
+            if diagnostics is not None:
+                stats.cached = True
+                return False, "", diagnostics, stats.to_json()
+
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            modified = reformat_rst_file(path, options, stats)
+
+        # A block that timed out may pass on the next run, so its diagnostic must not be replayed.
+        timed_out = stats.counts.get("block_timeouts", 0)
+        if cache is not None and key is not None and not modified and not timed_out:
+            cache.put(key, err.getvalue())
+    return modified, out.getvalue(), err.getvalue(), stats.to_json()
+
+
+def _reformat_files(
+    files: List[str], jobs: int, options: FormatOptions
+) -> Iterable[Tuple[bool, Dict[str, Any]]]:
+    """Reformat files, on a process pool if ``jobs > 1``. Output is replayed per file, in the
+    order of ``files``. Yields whether each file was modified, and its statistics."""
+    reformat = functools.partial(_reformat_rst_file_captured, options=options)
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            results = stack.enter_context(ProcessPoolExecutor(max_workers=jobs)).map(
+                reformat, files
+            )
+        else:
+            results = map(reformat, files)
+        for modified, out, err, stats in results:
+            sys.stderr.write(err)
+            sys.stderr.flush()
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            yield modified, stats
+
+
+def _profile(path: str, output: str) -> None:
+    """Write a cProfile dump of formatting ``path`` without caches. The file is formatted once
+    before profiling, so that the dump does not include importing the formatting modules."""
+    import cProfile
+
+    with open(path, "r", encoding="utf-8") as f:
+        src = f.read()
+    profiler = cProfile.Profile()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        format_rst_source(src, path)
+        profiler.runcall(format_rst_source, src, path)
+    profiler.dump_stats(output)
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of files to format in parallel (0 means one per CPU)",
+    )
+    parser.add_argument(
+        "--block-jobs",
+        type=int,
+        default=0,
+        help="number of processes that check the code blocks of each file, 0 to check them "
+        "in-process (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--block-timeout",
+        type=float,
+        default=DEFAULT_BLOCK_TIMEOUT,
+        help="seconds after which checking a code block fails, 0 for no limit "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="directory of the caches of clean files and checked code blocks "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="maximum number of entries per cache before evicting the least recently used "
+        "(default: %(default)s)",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the cache")
+    parser.add_argument(
+        "--clear-cache", action="store_true", help="invalidate all cache entries before running"
+    )
+    parser.add_argument(
+        "--since",
+        metavar="REV",
+        help="only format paragraphs and check code blocks that changed since git revision REV "
+        "(disables the cache of clean files)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run a daemon on localhost that keeps the formatter loaded between requests",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="format through the daemon if it is running, and in-process otherwise",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_DAEMON_PORT,
+        help="port of the daemon on localhost (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only report files that need formatting, without modifying them",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="print a unified diff of the formatting changes, without modifying files",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="FILE",
+        help="write timings and counters of each file to FILE as JSON lines ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="write a cProfile dump of formatting the slowest file to FILE",
+    )
+    parser.add_argument("files", nargs="*", help="reStructuredText files to format")
+    ns = parser.parse_args(args)
+
+    if ns.since is not None:
+        verify = subprocess.run(
+            ["git", "rev-parse", "--verify", "--quiet", f"{ns.since}^{{commit}}"],
+            stdout=subprocess.DEVNULL,
+        )
+        if verify.returncode != 0:
+            parser.error(f"--since: not a valid git revision: {ns.since}")
+
+    file_cache_dir = os.path.join(ns.cache_dir, "files")
+    block_cache_dir = os.path.join(ns.cache_dir, "blocks")
+    if ns.clear_cache:
+        DiskCache(file_cache_dir).clear()
+        DiskCache(block_cache_dir).clear()
+
+    # A partial check says nothing about the rest of the file, so it cannot use the file cache.
+    cache = None if ns.no_cache or ns.since else DiskCache(file_cache_dir, ns.cache_size)
+    block_cache = None if ns.no_cache else DiskCache(block_cache_dir, ns.cache_size)
+
+    files: List[str] = ns.files
+    jobs = ns.jobs if ns.jobs > 0 else (os.cpu_count() or 1)
+    jobs = min(jobs, len(files)) if files else 1
+    if ns.serve:
+        checker = CodeBlockChecker(block_cache, ns.block_jobs or None, ns.block_timeout or None)
+        serve(ns.port, checker)
+        return
+
+    options = FormatOptions(
+        cache=cache,
+        block_cache=block_cache,
+        block_jobs=ns.block_jobs or None,
+        block_timeout=ns.block_timeout or None,
+        since=ns.since,
+        daemon_port=ns.port if ns.daemon else None,
+        write=not (ns.check or ns.diff),
+        diff=ns.diff,
+    )
+
     modified = False
-    for f in files:
-        modified |= reformat_rst_file(f)
-    if modified:
+    all_stats = []
+    for file_modified, file_stats in _reformat_files(files, jobs, options):
+        modified |= file_modified
+        all_stats.append(file_stats)
+    if ns.stats:
+        with contextlib.ExitStack() as stack:
+            f = sys.stdout if ns.stats == "-" else stack.enter_context(open(ns.stats, "w"))
+            for file_stats in all_stats:
+                f.write(json.dumps(file_stats) + "\n")
+    if ns.profile and all_stats:
+        slowest = max(all_stats, key=lambda file_stats: file_stats["seconds"]["total"])
+        _profile(slowest["path"], ns.profile)
+    _code_block_checker(options).close()
+    for c in (cache, block_cache):
+        if c is not None:
+            c.prune()
+    if modified and options.write:
         subprocess.run(["git", "--no-pager", "diff", "--color=always", "--", *files])
     sys.exit(1 if modified else 0)
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""This script snapshots the regular expressions of spack.spec_parser.SpecTokens into
+bin/spec_tokens.py, so that the SpecLexer of conf.py does not import Spack. Run it whenever the
+_spack_root submodule is updated; the docs build warns if the snapshot is out of date."""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(ROOT, "bin", "spec_tokens.py")
+
+HEADER = '''\
+# Copyright Spack Project Developers. See COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+# This file is generated by bin/update_spec_tokens.py. Do not edit it by hand.
+
+"""The regular expressions of ``spack.spec_parser.SpecTokens``, so that the SpecLexer of conf.py
+does not need to import Spack."""
+
+import enum
+
+#: Version of Spack the tokens were taken from
+SPACK_VERSION = "{version}"
+#: SHA-256 of the spec_parser.py the tokens were taken from
+SPEC_PARSER_SHA256 = "{sha256}"
+
+
+class SpecTokens(enum.Enum):
+    """Token kinds of the spec grammar with their regular expressions, in order of precedence."""
+
+    def __new__(cls, regex):
+        token = object.__new__(cls)
+        token._value_ = len(cls.__members__) + 1
+        return token
+
+    def __init__(self, regex):
+        self.regex = regex
+
+'''
+
+
+def spec_parser_path(spack_root: str) -> str:
+    return os.path.join(spack_root, "lib", "spack", "spack", "spec_parser.py")
+
+
+def spec_parser_sha256(spack_root: str) -> str:
+    with open(spec_parser_path(spack_root), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def string_literal(value: str) -> str:
+    """A double-quoted literal of ``value``, raw if possible, as black would format it."""
+    if '"' not in value and "\n" not in value and not value.endswith("\\"):
+        return f'r"{value}"'
+    return json.dumps(value)
+
+
+def render(spack_root: str) -> str:
+    """The snapshot module of the spec tokens of the Spack in ``spack_root``."""
+    sys.path.insert(0, os.path.join(spack_root, "lib", "spack"))
+    import spack
+    from spack.spec_parser import SpecTokens
+
+    module = HEADER.format(version=str(spack.spack_version), sha256=spec_parser_sha256(spack_root))
+    for token in SpecTokens:
+        module += f"    {token.name} = {string_literal(token.regex)}\n"
+    return module
+
+
+def main(*args: str) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--spack-root",
+        default=os.path.join(ROOT, "_spack_root"),
+        help="Spack checkout to take the tokens from (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output", default=DEFAULT_OUTPUT, help="generated module (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only check that the generated module is up to date, without writing it",
+    )
+    ns = parser.parse_args(args)
+
+    if not os.path.exists(spec_parser_path(ns.spack_root)):
+        parser.error(f"no Spack checkout in {ns.spack_root}")
+    module = render(ns.spack_root)
+
+    try:
+        with open(ns.output, "r", encoding="utf-8") as f:
+            current = f.read()
+    except OSError:
+        current = None
+    if current == module:
+        return
+    if ns.check:
+        print(f"{ns.output} is out of date, run {sys.argv[0]}", file=sys.stderr)
+        sys.exit(1)
+    with open(ns.output, "w", encoding="utf-8") as f:
+        f.write(module)
+    print(f"Updated {ns.output}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -15,14 +15,36 @@
 # All configuration values have a default; values that are commented out
 # serve to show the default.
 
+import base64
+import functools
+import hashlib
+import io
+import json
+import logging
+import mimetypes
 import os
+import pathlib
+import re
+import subprocess
 import sys
+import time
 
+import sphinx.ext.graphviz
+import sphinx.search
+from docutils import nodes
 from pygments.formatters.html import HtmlFormatter
-from pygments.lexer import RegexLexer, default
+from pygments.lexer import ExtendedRegexLexer, default
 from pygments.token import *
 from sphinx.domains.python import PythonDomain
+from sphinx.environment import CONFIG_OK
 from sphinx.highlighting import PygmentsBridge
+from sphinx.util.matching import Matcher
+from sphinx.writers.html5 import HTML5Translator
+
+try:
+    import PIL.Image
+except ImportError:  # raster images are served as they are
+    PIL = None
 
 # -- Spack customizations -----------------------------------------------------
 # Add the Spack bin directory to the path so that we can use its output in docs.
@@ -33,17 +55,89 @@ os.environ["PATH"] += f"{os.pathsep}{os.path.abspath('_spack_root/bin')}"
 os.environ["COLIFY_SIZE"] = "25x120"
 os.environ["COLUMNS"] = "120"
 
-sys.path.insert(0, os.path.abspath("_spack_root/lib/spack/"))
+sys.path.insert(0, os.path.abspath("bin"))
+
+from format_rst_file import DiskCache
 
 
 class NoWhitespaceHtmlFormatter(HtmlFormatter):
-    """HTML formatter that suppresses redundant span elements for Text.Whitespace tokens."""
+    """HTML formatter that suppresses redundant span elements for Text.Whitespace tokens, and
+    merges adjacent tokens of the same class into one span."""
 
     def _get_css_classes(self, ttype):
         # For Text.Whitespace return an empty string, which avoids <span class="w"> </span>
         # elements from being generated.
         return "" if ttype is Text.Whitespace else super()._get_css_classes(ttype)
 
+    def _merges_spans(self):
+        # Line numbers, line anchors and tags files need the output of _format_lines line by line.
+        return not (
+            self.noclasses
+            or self.linenos
+            or self.lineanchors
+            or self.linespans
+            or self.tagsfile
+            or self.debug_token_types
+        )
+
+    def _highlight_lines(self, tokensource):
+        # Merged spans may cross lines, so _format_lines wraps emphasized lines itself.
+        return tokensource if self._merges_spans() else super()._highlight_lines(tokensource)
+
+    def _format_lines(self, tokensource):
+        if not self._merges_spans():
+            yield from super()._format_lines(tokensource)
+            return
+        # Without per-line markup, spans may cross lines. Tokens of the same class share a span,
+        # also when only whitespace separates them, instead of one span per token and line. Only
+        # the lines of :emphasize-lines: are wrapped in a span of their own.
+        html = []
+        span = ""  # class of the open span
+        blanks = []  # whitespace after the open span, which the next token may continue
+        line = 1
+        hll = False  # whether the span of an emphasized line is open
+
+        def close():
+            nonlocal span
+            html.append("</span>" if span else "")
+            html.extend(blanks)
+            blanks.clear()
+            span = ""
+
+        def emit(css_class, text):
+            nonlocal span, hll
+            if line in self.hl_lines and not hll:
+                close()
+                html.append('<span class="hll">')
+                hll = True
+            if not css_class and span and text.isspace():
+                blanks.append(text)
+                return
+            if css_class != span:
+                close()
+                html.append(f'<span class="{css_class}">' if css_class else "")
+                span = css_class
+            else:
+                html.extend(blanks)
+                blanks.clear()
+            html.append(text)
+
+        for ttype, value in tokensource:
+            css_class = self._get_css_classes(ttype)
+            for i, part in enumerate(self._translate_parts(value)):
+                if i:
+                    emit("", self.lineseparator)
+                    if hll:
+                        close()
+                        html.append("</span>")
+                        hll = False
+                    line += 1
+                if part:
+                    emit(css_class, part)
+        close()
+        html.append("</span>" if hll else "")
+        yield 1, "".join(html)
+
 
 class CustomPygmentsBridge(PygmentsBridge):
     def get_formatter(self, **options):
@@ -54,13 +148,1126 @@ class CustomPygmentsBridge(PygmentsBridge):
 # See https://github.com/pygments/pygments/issues/1905#issuecomment-3170486995.
 PygmentsBridge.html_formatter = NoWhitespaceHtmlFormatter
 
-# Enable todo items
-todo_include_todos = True
+# Most code blocks, in particular the console outputs in outputs/, do not change between builds,
+# so highlighted blocks are cached on disk, outside of _build. The cache is set up when the
+# builder is initialized, see setup_highlight_cache.
+highlight_cache = None
+
+
+@functools.lru_cache(maxsize=None)
+def highlight_cache_salt():
+    """Everything besides a code block and its options that determines its highlighted HTML:
+    the versions of Pygments and Sphinx, this file, which defines the lexer and formatter, and
+    the Spack spec tokens that SpecLexer uses."""
+    import pygments
+    import sphinx
+
+    with open(__file__, "rb") as f:
+        conf_hash = hashlib.sha256(f.read()).hexdigest()
+    tokens = "".join(token.regex for token in SpecTokens)
+    return "\0".join((pygments.__version__, sphinx.__version__, conf_hash, tokens))
+
+
+def highlight_cache_key(bridge, source, lang, opts, force, kwargs):
+    formatter_args = {**kwargs, **bridge.formatter_args}
+    parts = (
+        highlight_cache_salt(),
+        bridge.dest,
+        str(bridge.latex_engine),
+        f"{bridge.formatter.__module__}.{bridge.formatter.__qualname__}",
+        repr(sorted((key, repr(value)) for key, value in formatter_args.items())),
+        lang,
+        repr(sorted((key, repr(value)) for key, value in (opts or {}).items())),
+        str(force),
+        source,
+    )
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+class WarningRecorder(logging.Handler):
+    """Counts the warnings logged while highlighting a code block."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+uncached_highlight_block = getattr(
+    PygmentsBridge, "uncached_highlight_block", PygmentsBridge.highlight_block
+)
+
+
+def cached_highlight_block(self, source, lang, opts=None, force=False, location=None, **kwargs):
+    """PygmentsBridge.highlight_block, memoized in the highlight cache. Blocks that Sphinx warns
+    about are not cached, so that builds with a warm cache report the same warnings."""
+    if highlight_cache is None:
+        return uncached_highlight_block(self, source, lang, opts, force, location, **kwargs)
+    if not isinstance(source, str):
+        source = source.decode()
+    key = highlight_cache_key(self, source, lang, opts, force, kwargs)
+    highlighted = highlight_cache.get(key)
+    if highlighted is not None:
+        return highlighted
+    logger = logging.getLogger("sphinx.sphinx.highlighting")
+    warnings = WarningRecorder()
+    logger.addHandler(warnings)
+    try:
+        highlighted = uncached_highlight_block(self, source, lang, opts, force, location, **kwargs)
+    finally:
+        logger.removeHandler(warnings)
+    if not warnings.count:
+        highlight_cache.put(key, highlighted)
+    return highlighted
+
+
+PygmentsBridge.uncached_highlight_block = uncached_highlight_block
+PygmentsBridge.highlight_block = cached_highlight_block
+
+
+def setup_highlight_cache(app):
+    global highlight_cache
+    if app.config.highlight_cache_dir:
+        highlight_cache = DiskCache(
+            app.config.highlight_cache_dir, app.config.highlight_cache_size
+        )
+
+
+def prune_highlight_cache(app, exception):
+    if highlight_cache is not None:
+        highlight_cache.prune()
+
+
+# Sphinx rereads a page when a file it includes, like the console outputs in outputs/, is newer
+# than the page's last read, even if its content did not change. The environment therefore maps
+# each page to the SHA-256 of its source and of each file it includes, and pages whose files all
+# have the same content are not reread.
+def file_sha256(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def init_dependency_hashes(app):
+    if not hasattr(app.env, "dependency_hashes"):
+        app.env.dependency_hashes = {}
+
+
+def record_dependency_hashes(app, doctree):
+    env = app.env
+    # Dependencies are relative to the source directory, not to the working directory.
+    paths = [
+        env.doc2path(env.docname),
+        *(os.path.join(app.srcdir, dep) for dep in env.dependencies.get(env.docname, ())),
+    ]
+    hashes = {os.path.relpath(path, app.srcdir): file_sha256(path) for path in paths}
+    # Like Sphinx, reread pages with missing dependencies on every build.
+    if None not in hashes.values():
+        env.dependency_hashes[env.docname] = hashes
+
+
+def purge_dependency_hashes(app, env, docname):
+    env.dependency_hashes.pop(docname, None)
+
+
+def merge_dependency_hashes(app, env, docnames, other):
+    env.dependency_hashes.update(
+        (docname, other.dependency_hashes[docname])
+        for docname in docnames
+        if docname in other.dependency_hashes
+    )
+
+
+def skip_unchanged_docs(app, env, added, changed, removed):
+    """Drop pages from the ``changed`` set whose source and dependencies have the same content as
+    when they were last read. Configuration changes still reread everything, and pages that Sphinx
+    rereads on every build, like those with a :glob: toctree, are still reread."""
+    if env.config_status != CONFIG_OK:
+        return []
+    changed.difference_update(
+        [
+            docname
+            for docname in changed
+            if docname in env.dependency_hashes
+            and docname not in env.reread_always
+            and all(
+                file_sha256(os.path.join(app.srcdir, path)) == sha256
+                for path, sha256 in env.dependency_hashes[docname].items()
+            )
+        ]
+    )
+    return []
+
+
+# The search index would have every word of the console outputs that pages include, which are
+# mostly package lists, hashes and build logs. Of console outputs, that is of literal blocks
+# included from outputs/ and console code blocks, only the command lines are indexed.
+OUTPUTS_DIR = os.path.abspath("outputs")
+CONSOLE_COMMAND = re.compile(r"^\$ (.*(?:\\\n.*)*)", re.MULTILINE)
+
+unfiltered_feed_visit_nodes = getattr(
+    sphinx.search, "unfiltered_feed_visit_nodes", sphinx.search._feed_visit_nodes
+)
+
+
+def is_console_output(node):
+    if node.get("language") == "console":
+        return True
+    source = node.get("source")
+    return bool(source) and os.path.abspath(source).startswith(OUTPUTS_DIR + os.sep)
+
+
+def feed_console_commands(node, *, word_store, split, language):
+    """sphinx.search._feed_visit_nodes, which only indexes the command lines of console outputs,
+    including their continuation lines, without the prompt."""
+    if isinstance(node, nodes.literal_block) and is_console_output(node):
+        commands = CONSOLE_COMMAND.findall(node.astext())
+        word_store.words.extend(split("\n".join(commands)))
+        return
+    unfiltered_feed_visit_nodes(node, word_store=word_store, split=split, language=language)
+
+
+sphinx.search.unfiltered_feed_visit_nodes = unfiltered_feed_visit_nodes
+sphinx.search._feed_visit_nodes = feed_console_commands
+
+
+# dot runs for each graph in every fresh build, so rendered SVGs are cached on disk as well,
+# outside of _build, keyed by the dot source, its options and graphviz_dot_args. The cache is set
+# up when the builder is initialized, see setup_graphviz_cache.
+graphviz_cache = None
+
+SVG_COMMENT = re.compile(r"<!--.*?-->|<!DOCTYPE[^>]*>|<title>[^<]*</title>", re.DOTALL)
+SVG_BLANKS = re.compile(r">\s*\n\s*<")
+SVG_NEWLINE = re.compile(r"\s*\n\s*")
+SVG_SIZE = re.compile(r'<svg\b[^>]*?\swidth="([\d.]+)pt"[^>]*?\sheight="([\d.]+)pt"')
+
+
+def optimize_svg(svg):
+    """Strip the comments, doctype, tooltips and indentation of an SVG, like those dot writes.
+    The SVGs are embedded as images, which show no tooltips."""
+    svg = SVG_BLANKS.sub("><", SVG_COMMENT.sub("", svg))
+    return SVG_NEWLINE.sub(" ", svg.strip()) + "\n"
+
+
+uncached_render_dot = getattr(
+    sphinx.ext.graphviz, "uncached_render_dot", sphinx.ext.graphviz.render_dot
+)
+object_render_dot_html = getattr(
+    sphinx.ext.graphviz, "object_render_dot_html", sphinx.ext.graphviz.render_dot_html
+)
+
+
+@functools.lru_cache(maxsize=None)
+def graphviz_version(dot):
+    """The version that ``dot -V`` reports, or an empty string if dot cannot be run."""
+    try:
+        result = subprocess.run([dot, "-V"], capture_output=True, text=True)
+    except OSError:
+        return ""
+    # dot prints its version to stderr
+    return (result.stderr or result.stdout).strip()
+
+
+def cached_render_dot(self, code, options, format, prefix="graphviz", filename=None):
+    """sphinx.ext.graphviz.render_dot, which for SVGs optimizes the output and memoizes it in the
+    graphviz cache."""
+    if format != "svg":
+        return uncached_render_dot(self, code, options, format, prefix, filename)
+    config = self.builder.config
+    dot = str(options.get("graphviz_dot", config.graphviz_dot))
+    parts = (
+        self.builder.name,
+        dot,
+        graphviz_version(dot),
+        repr(list(config.graphviz_dot_args)),
+        repr(sorted((key, repr(value)) for key, value in options.items())),
+        code,
+    )
+    key = hashlib.sha256("\0".join(parts).encode()).hexdigest()
+    fname = f"{prefix}-{key}.svg"
+    outfn = os.path.join(self.builder.outdir, self.builder.imagedir, fname)
+    if not os.path.isfile(outfn):
+        svg = graphviz_cache.get(key) if graphviz_cache is not None else None
+        if svg is None:
+            _, dot_outfn = uncached_render_dot(self, code, options, format, prefix, filename)
+            if dot_outfn is None:
+                return None, None
+            with open(dot_outfn, "r", encoding="utf-8") as f:
+                svg = optimize_svg(f.read())
+            os.remove(dot_outfn)
+            if graphviz_cache is not None:
+                graphviz_cache.put(key, svg)
+        os.makedirs(os.path.dirname(outfn), exist_ok=True)
+        with open(outfn, "w", encoding="utf-8") as f:
+            f.write(svg)
+    return pathlib.PurePosixPath(self.builder.imgpath, fname), outfn
+
+
+def lazy_render_dot_html(
+    self, node, code, options, prefix="graphviz", imgcls=None, alt=None, filename=None
+):
+    """sphinx.ext.graphviz.render_dot_html, which embeds SVGs as images with their size, so that
+    browsers load them lazily without reflowing the page, instead of as objects."""
+    if self.builder.config.graphviz_output_format != "svg":
+        return object_render_dot_html(self, node, code, options, prefix, imgcls, alt, filename)
+    try:
+        fname, outfn = sphinx.ext.graphviz.render_dot(self, code, options, "svg", prefix, filename)
+    except sphinx.ext.graphviz.GraphvizError as exc:
+        from sphinx.util import logging as sphinx_logging
+
+        sphinx_logging.getLogger(__name__).warning("dot code %r: %s", code, exc)
+        raise nodes.SkipNode from exc
+
+    if fname is None:
+        self.body.append(self.encode(code))
+        raise nodes.SkipNode
+    classes = " ".join(filter(None, [imgcls, "graphviz", *node.get("classes", [])]))
+    if alt is None:
+        alt = self.attval(node["alt"]) if "alt" in node else self.encode(code).strip()
+    with open(outfn, "r", encoding="utf-8") as f:
+        size = SVG_SIZE.search(f.read())
+    dimensions = ""
+    if size:
+        # dot sizes SVGs in points, HTML in CSS pixels
+        width, height = (round(float(pt) * 4 / 3) for pt in size.groups())
+        dimensions = f' width="{width}" height="{height}"'
+    if "align" in node:
+        self.body.append(f'<div align="{node["align"]}" class="align-{node["align"]}">')
+    self.body.append('<div class="graphviz">')
+    self.body.append(
+        f'<img src="{fname}" alt="{alt}" class="{classes}"{dimensions} loading="lazy" '
+        'decoding="async" />'
+    )
+    self.body.append("</div>\n")
+    if "align" in node:
+        self.body.append("</div>\n")
+    raise nodes.SkipNode
+
+
+sphinx.ext.graphviz.uncached_render_dot = uncached_render_dot
+sphinx.ext.graphviz.object_render_dot_html = object_render_dot_html
+sphinx.ext.graphviz.render_dot = cached_render_dot
+sphinx.ext.graphviz.render_dot_html = lazy_render_dot_html
+
+
+def setup_graphviz_cache(app):
+    global graphviz_cache
+    if app.config.graphviz_cache_dir:
+        graphviz_cache = DiskCache(app.config.graphviz_cache_dir, app.config.graphviz_cache_size)
+
+
+def prune_graphviz_cache(app, exception):
+    if graphviz_cache is not None:
+        graphviz_cache.prune()
+
+
+# sphinx_last_updated_by_git asks git for the dates of the source of each page and of the files
+# it includes, directory by directory. Instead, one pass over the git log gives the date of the
+# last commit of every file, which is cached by HEAD commit. It fills env.git_last_updated, which
+# feeds html_last_updated_fmt and sitemap_show_lastmod, before the extension runs; the extension
+# only asks git about pages left unfilled, that is pages that include files of submodules.
+git_dates_cache = None
+
+
+def git_commit_dates(repo):
+    """The author date of the last commit of each file in HEAD of the git repository ``repo``,
+    including merge commits, by path relative to ``repo``, and the paths of its submodules. None
+    for shallow clones, whose history does not have the dates of all files."""
+
+    def git(*args):
+        return subprocess.run(
+            ["git", "-c", "core.quotePath=false", *args],
+            cwd=repo,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+    try:
+        if git("rev-parse", "--is-shallow-repository").strip() != "false":
+            return None
+        head = git("rev-parse", "HEAD").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    key = hashlib.sha256(f"{head}\0{os.path.realpath(repo)}".encode()).hexdigest()
+    cached = git_dates_cache.get(key) if git_dates_cache is not None else None
+    if cached is not None:
+        return json.loads(cached)
+
+    files, submodules = set(), []
+    for entry in git("ls-tree", "-r", "HEAD").splitlines():
+        info, path = entry.split("\t", 1)
+        if info.split()[1] == "commit":
+            submodules.append(path)
+        else:
+            files.add(path)
+    dates = {}
+    timestamp = 0
+    for line in git("log", "-m", "--relative", "--name-only", "--format=%x00%at").splitlines():
+        if line.startswith("\0"):
+            timestamp = int(line[1:])
+        elif line in files and timestamp > dates.get(line, 0):
+            dates[line] = timestamp
+    if git_dates_cache is not None:
+        git_dates_cache.put(key, json.dumps([dates, submodules]))
+    return dates, submodules
+
+
+def fill_git_last_updated(app, env):
+    pending = [docname for docname, data in env.git_last_updated.items() if data is None]
+    if not pending or app.config.git_exclude_commits:
+        return
+    index = git_commit_dates(app.srcdir)
+    if index is None:
+        return
+    dates, submodules = index
+    excluded = Matcher(app.config.git_exclude_patterns)
+    srcdir = os.path.realpath(app.srcdir)
+
+    def commit_date(path):
+        """The date of ``path`` from the index, 0 if it is untracked, None if the index does not
+        cover it."""
+        path = pathlib.Path(os.path.relpath(os.path.realpath(path), srcdir)).as_posix()
+        if path.startswith("../") or any(path.startswith(f"{sub}/") for sub in submodules):
+            return None
+        return dates.get(path, 0)
+
+    for docname in pending:
+        if excluded(str(env.doc2path(docname, False))):
+            continue
+        source = commit_date(env.doc2path(docname))
+        if source is None:
+            continue
+        deps = [dep for dep in env.dependencies.get(docname, ()) if not excluded(str(dep))]
+        # Leave pages with missing dependencies to the extension, which warns about them.
+        if not all(os.path.exists(os.path.join(app.srcdir, dep)) for dep in deps):
+            continue
+        deps = [commit_date(os.path.join(app.srcdir, dep)) for dep in deps]
+        if None in deps:
+            continue
+        if not source and not app.config.git_untracked_check_dependencies:
+            deps = []
+        timestamp = max([source, *deps])
+        show_sourcelink = bool(source) or app.config.git_untracked_show_sourcelink
+        env.git_last_updated[docname] = (str(timestamp) if timestamp else None), show_sourcelink
+
+
+def setup_git_dates_cache(app):
+    global git_dates_cache
+    if app.config.git_dates_cache_dir:
+        git_dates_cache = DiskCache(
+            app.config.git_dates_cache_dir, app.config.git_dates_cache_size
+        )
+
+
+def prune_git_dates_cache(app, exception):
+    if git_dates_cache is not None:
+        git_dates_cache.prune()
+
+
+# The files of _static that pages reference are minified and copied to the output with a hash of
+# their content in the name, so that they can be cached for good: a changed file gets a new name.
+# The names are chosen when the configuration is read, see fingerprint_static_files, and the
+# copies written when the builder is initialized, see write_fingerprinted_files.
+fingerprinted_files = {}
+
+CSS_TOKEN = re.compile(
+    r"""(?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(?P<comment>/\*.*?\*/)|(?P<space>\s+)|"""
+    r"""(?P<punct>[{};:,>()])|(?P<other>[^"'/\s{};:,>()]+|/)""",
+    re.DOTALL,
+)
+JS_TOKEN = re.compile(
+    r"""(?P<comment>//[^\n]*|/\*.*?\*/)|(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|"""
+    r"""(?P<space>\s+)|(?P<template>`)|(?P<brace>[{}])|(?P<other>[^"'`{}/\s]+|/)""",
+    re.DOTALL,
+)
+JS_TEMPLATE_TEXT = re.compile(r"(?:\\.|[^`\\$]|\$(?!\{))*", re.DOTALL)
+JS_PUNCTUATION = "{}()[];,:=<>!&|?.*+-"
+SVG_STYLE = re.compile(r"(<style\b[^>]*>)(.*?)(</style>)", re.DOTALL)
+
+
+def minify_css(css):
+    """Drop the comments of a style sheet and the whitespace that is not needed between tokens.
+    Strings are kept as they are."""
+    out = []
+    space = False
+    for match in CSS_TOKEN.finditer(css):
+        kind, token = match.lastgroup, match.group()
+        if kind in ("space", "comment"):
+            space = True
+            continue
+        if space and out and out[-1][-1] not in "{};:,>(" and token[0] not in "{};,>)":
+            out.append(" ")
+        if token.startswith("}") and out and out[-1] == ";":
+            out.pop()
+        out.append(token)
+        space = False
+    return "".join(out) + "\n"
+
+
+def minify_js(js):
+    """Drop the comments of a script and the whitespace that is not needed between tokens. Line
+    breaks are kept where they could end a statement. Strings and template literals are kept as
+    they are; the scripts must not contain regular expression literals."""
+    out = []
+    space = ""
+    # brace depth within each ${...} substitution of the enclosing template literals
+    substitutions = []
+    pos = 0
+    while pos < len(js):
+        match = JS_TOKEN.match(js, pos)
+        kind, token = match.lastgroup, match.group()
+        pos = match.end()
+        if kind in ("space", "comment"):
+            if "\n" in token or kind == "comment" and token.startswith("//"):
+                space = "\n"
+            elif not space:
+                space = " "
+            continue
+        if space and out:
+            before, after = out[-1][-1], token[0]
+            if space == "\n":
+                if before not in "{([,;" and after not in "})].,;":
+                    out.append("\n")
+            elif before in "+-" and after in "+-":
+                out.append(" ")
+            elif before not in JS_PUNCTUATION and after not in JS_PUNCTUATION:
+                out.append(" ")
+        space = ""
+        if kind == "brace" and substitutions:
+            if token == "{":
+                substitutions[-1] += 1
+            elif substitutions[-1]:
+                substitutions[-1] -= 1
+            else:
+                # end of a substitution, back in the text of its template literal
+                substitutions.pop()
+                kind = "template"
+        out.append(token)
+        while kind == "template":
+            text = JS_TEMPLATE_TEXT.match(js, pos)
+            out.append(text.group())
+            pos = text.end()
+            if js.startswith("${", pos):
+                out.append("${")
+                pos += 2
+                substitutions.append(0)
+            elif pos < len(js):
+                out.append("`")
+                pos += 1
+            kind = None
+    return "".join(out) + "\n"
+
+
+def minify_svg(svg):
+    """optimize_svg, which also minifies the style sheets of the SVG."""
+    return SVG_STYLE.sub(
+        lambda m: m.group(1) + minify_css(m.group(2)).strip() + m.group(3), optimize_svg(svg)
+    )
+
+
+MINIFIERS = {".css": minify_css, ".js": minify_js, ".svg": minify_svg}
+
+
+def fingerprint_static_files(app, config):
+    """Choose the names of the minified copies of fingerprint_static_path, and reference them in
+    html_css_files, the logos of html_theme_options, and the static_files of html_context for
+    the templates."""
+    fingerprinted_files.clear()
+    static_files = {}
+    for name in config.fingerprint_static_path:
+        path = os.path.join(app.srcdir, "_static", name)
+        root, ext = os.path.splitext(name)
+        with open(path, "r", encoding="utf-8") as f:
+            content = MINIFIERS[ext](f.read())
+        digest = hashlib.sha256(content.encode()).hexdigest()[:12]
+        static_files[name] = f"{root}.{digest}{ext}"
+        fingerprinted_files[static_files[name]] = content
+    config.html_css_files = [
+        static_files.get(css, css) if isinstance(css, str) else css
+        for css in config.html_css_files
+    ]
+    config.html_theme_options = {
+        key: static_files.get(value, value) if isinstance(value, str) else value
+        for key, value in config.html_theme_options.items()
+    }
+    config.html_context = {**config.html_context, "static_files": static_files}
+
+
+def write_fingerprinted_files(app):
+    if app.builder.format != "html":
+        return
+    for name, content in fingerprinted_files.items():
+        path = os.path.join(app.outdir, "_static", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+# Images are served in variants of the size they are shown at: resized PNGs or JPEGs and WebPs
+# of raster images, which need Pillow, and minified copies of SVGs. The variants of an image are
+# chosen and written when its page is read, see plan_image_variants, and written again by the
+# HTML writer if they have gone missing since, see responsive_visit_image. Resized images are
+# cached on disk by the content of the source image.
+# The cache is set up when the builder is initialized, see setup_image_cache.
+image_cache = None
+
+#: Widths of the variants of raster images that have no size and are shown at most as wide as
+#: the page, and the width of the page in Furo
+IMAGE_WIDTHS = (480, 960, 1440)
+IMAGE_SIZES = "(max-width: 46em) 100vw, 46em"
+#: Characters of text before an image, beyond which it is assumed to be below the fold
+IMAGE_FOLD = 1000
+#: Quality of lossy variants, from 0 to 100
+IMAGE_QUALITY = 85
+#: Effort of WebP encoding, from 0 to 6. Method 6 is up to 50 times slower than 4 on the images
+#: of the tutorial, for 2 to 4% fewer bytes.
+WEBP_METHOD = 4
+#: Effort of lossless WebP encoding, from 0 to 100
+WEBP_LOSSLESS_EFFORT = 50
+#: Formats of the fallback variants of raster images by MIME type of their source
+FALLBACK_FORMATS = {"image/png": "png", "image/jpeg": "jpeg"}
+
+
+def resize_image(path, width, format):
+    """The image at ``path`` scaled down to ``width`` pixels and saved as ``format``, memoized in
+    the image cache. WebPs of PNGs are lossless if that is smaller."""
+    with open(path, "rb") as f:
+        source = f.read()
+    parts = (PIL.__version__, format, str(width), str(IMAGE_QUALITY))
+    parts += (str(WEBP_METHOD), str(WEBP_LOSSLESS_EFFORT))
+    key = hashlib.sha256("\0".join(parts).encode() + b"\0" + source).hexdigest()
+    data = image_cache.get(key) if image_cache is not None else None
+    if data is not None:
+        return key, base64.b64decode(data)
+
+    image = PIL.Image.open(io.BytesIO(source))
+    original = image.format.lower(), image.width
+    palette = image.mode == "P"
+    if image.mode in ("1", "P"):
+        image = image.convert("RGBA")
+    if width < image.width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), PIL.Image.Resampling.LANCZOS)
+    encoded = []
+    if format == "webp":
+        encoded.append({"quality": IMAGE_QUALITY, "method": WEBP_METHOD})
+        if path.endswith(".png"):
+            lossless = {"lossless": True, "quality": WEBP_LOSSLESS_EFFORT, "method": WEBP_METHOD}
+            encoded.append(lossless)
+    elif format == "png":
+        if palette:
+            image = image.quantize(256, method=PIL.Image.Quantize.FASTOCTREE)
+        encoded.append({"optimize": True})
+    else:
+        image = image.convert("RGB")
+        encoded.append({"quality": IMAGE_QUALITY, "optimize": True, "progressive": True})
+    data = min((image_bytes(image, format, options) for options in encoded), key=len)
+    if original == (format, width):
+        data = min(data, source, key=len)
+    if image_cache is not None:
+        image_cache.put(key, base64.b64encode(data).decode())
+    return key, data
+
+
+def image_bytes(image, format, options):
+    out = io.BytesIO()
+    image.save(out, format.upper(), **options)
+    return out.getvalue()
+
+
+def image_variant_name(path, width, format):
+    """Name of a variant in the image directory of the builder, and its content."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if format == "svg":
+        with open(path, "r", encoding="utf-8") as f:
+            svg = minify_svg(f.read()).encode()
+        return f"{stem}.{hashlib.sha256(svg).hexdigest()[:12]}.svg", svg
+    key, data = resize_image(path, width, format)
+    return f"{stem}-{width}w.{key[:12]}.{'jpg' if format == 'jpeg' else format}", data
+
+
+def display_size(node, width, height):
+    """The size in CSS pixels at which an image of ``width`` by ``height`` pixels is shown, or
+    None if it is only limited by the width of the page."""
+    scale = node.get("scale", 100) / 100
+    measures = {}
+    for dimension in ("width", "height"):
+        if dimension in node:
+            value, unit = nodes.parse_measure(node[dimension])
+            if unit not in ("", "px"):
+                return None
+            measures[dimension] = value * scale
+    if "width" in measures:
+        return measures["width"], measures.get("height", measures["width"] * height / width)
+    if "height" in measures:
+        return measures["height"] * width / height, measures["height"]
+    if "scale" in node:
+        return width * scale, height * scale
+    return None
+
+
+def write_image_variant(outdir, name, data):
+    outfn = os.path.join(outdir, name)
+    if not os.path.isfile(outfn):
+        os.makedirs(outdir, exist_ok=True)
+        with open(outfn, "wb") as f:
+            f.write(data)
+
+
+def image_variants(path, mimetype, node, outdir):
+    """The variants of the image at ``path`` for the HTML writer: its size, whether the srcset
+    uses pixel densities or widths, and a list of (name, width, format, bytes), with the WebPs
+    first if they are smaller than the fallback. The variants are written to ``outdir`` while
+    their bytes are at hand, so that they are encoded once also without the image cache."""
+    if mimetype == "image/svg+xml":
+        name, data = image_variant_name(path, None, "svg")
+        write_image_variant(outdir, name, data)
+        return {"variants": [(name, None, "svg", len(data))]}
+    with PIL.Image.open(path) as image:
+        width, height = image.size
+    shown = display_size(node, width, height)
+    if shown:
+        # at one and two device pixels per CSS pixel
+        density = True
+        widths = sorted({min(width, round(shown[0] * d)) for d in (1, 2)})
+    else:
+        density = False
+        shown = width, height
+        widths = [w for w in IMAGE_WIDTHS if w < width] + [width]
+    variants = {}
+    for format in ("webp", FALLBACK_FORMATS[mimetype]):
+        for w in widths:
+            name, data = image_variant_name(path, w, format)
+            variants.setdefault(format, []).append((name, w, format, data))
+    webp, fallback = variants.values()
+    # Resized diagrams with few colors may be smaller as PNGs
+    if sum(len(data) for *_, data in webp) >= sum(len(data) for *_, data in fallback):
+        webp = []
+    for name, *_, data in webp + fallback:
+        write_image_variant(outdir, name, data)
+    size = [str(round(value)) for value in shown]
+    variants = [(name, w, format, len(data)) for name, w, format, data in webp + fallback]
+    return {"size": size, "density": density, "variants": variants}
+
+
+def init_image_bytes(app):
+    if not hasattr(app.env, "image_bytes"):
+        app.env.image_bytes = {}
+
+
+def plan_image_variants(app, doctree):
+    """Mark the images below the fold of a page to be loaded lazily, and choose the variants of
+    each local PNG, JPEG and SVG image. Record the bytes of the images of the page and of their
+    largest variants for report_image_bytes."""
+    env = app.env
+    env.image_bytes.pop(env.docname, None)
+    if app.builder.format != "html":
+        return
+    outdir = os.path.join(app.builder.outdir, app.builder.imagedir)
+    text = 0
+    for node in doctree.findall(lambda node: isinstance(node, (nodes.Text, nodes.image))):
+        if isinstance(node, nodes.Text):
+            text += len(node)
+            continue
+        if text > IMAGE_FOLD:
+            node.setdefault("loading", "lazy")
+        for mimetype, uri in node.get("candidates", {}).items():
+            path = os.path.join(app.srcdir, uri)
+            if not os.path.isfile(path):
+                continue
+            if mimetype == "*":
+                mimetype = mimetypes.guess_type(uri)[0]
+            if mimetype != "image/svg+xml" and (PIL is None or mimetype not in FALLBACK_FORMATS):
+                continue
+            plan = image_variants(path, mimetype, node, outdir)
+            node.setdefault("image_variants", {})[uri] = plan
+            # the largest variant that browsers fetch, WebPs where they are offered
+            served = [v for v in plan["variants"] if v[2] == plan["variants"][0][2]]
+            largest = max(size for *_, size in served)
+            env.image_bytes.setdefault(env.docname, []).append(
+                (uri, os.path.getsize(path), largest)
+            )
+
+
+def purge_image_bytes(app, env, docname):
+    env.image_bytes.pop(docname, None)
+
+
+def merge_image_bytes(app, env, docnames, other):
+    env.image_bytes.update(
+        (docname, other.image_bytes[docname])
+        for docname in docnames
+        if docname in other.image_bytes
+    )
+
+
+plain_visit_image = getattr(HTML5Translator, "plain_visit_image", HTML5Translator.visit_image)
+
+
+def responsive_visit_image(self, node):
+    """HTML5Translator.visit_image, which writes the variants of the image chosen by
+    plan_image_variants to the image directory and shows the image in a picture element with a
+    WebP and a fallback srcset. Lazily loaded images are also decoded asynchronously."""
+    uri = node["uri"]
+    plan = node.get("image_variants", {}).get(uri)
+    if plan is None:
+        plain_visit_image(self, node)
+        return
+    if "size" in plan and "width" not in node and "height" not in node and "scale" not in node:
+        node["width"], node["height"] = plan["size"]
+    plain_visit_image(self, node)
+
+    path = os.path.join(self.builder.srcdir, uri)
+    outdir = os.path.join(self.builder.outdir, self.builder.imagedir)
+    srcsets = {}
+    for name, width, format, _ in plan["variants"]:
+        # plan_image_variants wrote the variant, unless the page was read by an earlier build
+        if not os.path.isfile(os.path.join(outdir, name)):
+            write_image_variant(outdir, name, image_variant_name(path, width, format)[1])
+        srcsets.setdefault(format, []).append((f"{self.builder.imgpath}/{name}", width))
+
+    attributes = ' decoding="async"' if node.get("loading") == "lazy" else ""
+    if "svg" in srcsets:
+        src = f' src="{srcsets["svg"][0][0]}"{attributes}'
+        self.body[-1] = re.sub(r' src="[^"]*"', src, self.body[-1], count=1)
+        return
+
+    fallback = next(format for format in srcsets if format != "webp")
+    widths = [width for _, width in srcsets[fallback]]
+    if plan["density"]:
+        descriptors = [f"{width / float(plan['size'][0]):.3g}x" for width in widths]
+        sizes = ""
+    else:
+        descriptors = [f"{width}w" for width in widths]
+        sizes = f' sizes="{IMAGE_SIZES}"'
+
+    def srcset(format):
+        return ", ".join(f"{src} {d}" for (src, _), d in zip(srcsets[format], descriptors))
+
+    # browsers without srcset get the image at one pixel per CSS pixel, or at full size
+    src = srcsets[fallback][0 if plan["density"] else -1][0]
+    img = re.sub(
+        r' src="[^"]*"',
+        f' src="{src}" srcset="{srcset(fallback)}"{sizes}{attributes}',
+        self.body[-1],
+        count=1,
+    )
+    if "webp" not in srcsets:
+        self.body[-1] = img
+        return
+    suffix = "\n" if img.endswith("\n") else ""
+    self.body[-1] = (
+        f'<picture><source srcset="{srcset("webp")}"{sizes} type="image/webp" />'
+        f"{img.rstrip()}</picture>{suffix}"
+    )
+
+
+HTML5Translator.plain_visit_image = plain_visit_image
+HTML5Translator.visit_image = responsive_visit_image
+
+
+def report_image_bytes(app, exception):
+    """Log the bytes of the images of each page, and of the largest variants that browsers fetch
+    instead."""
+    if exception is not None or app.builder.format != "html" or not app.env.image_bytes:
+        return
+    from sphinx.util import logging as sphinx_logging
+
+    logger = sphinx_logging.getLogger(__name__)
+    logger.info("image bytes per page, original -> largest variant served:")
+    total = saved = 0
+    for docname, images in sorted(app.env.image_bytes.items()):
+        original = sum(size for _, size, _ in images)
+        served = sum(size for _, _, size in images)
+        logger.info(f"  {docname}: {original} -> {served} ({original - served} saved)")
+        total += original
+        saved += original - served
+    logger.info(f"  total: {total} -> {total - saved} ({saved} saved)")
+
+
+def setup_image_cache(app):
+    global image_cache
+    if app.config.image_cache_dir:
+        image_cache = DiskCache(app.config.image_cache_dir, app.config.image_cache_size)
+
+
+def prune_image_cache(app, exception):
+    if image_cache is not None:
+        image_cache.prune()
+
+
+#: Set to profile the build, to the number of documents to summarize or to 1 for the default
+PROFILE_ENV = "SPACK_TUTORIAL_PROFILE"
+PROFILE_TOP = 10
+
+
+class BuildProfile:
+    """Records the wall time and the peak of memory traced by tracemalloc of reading, resolving
+    and writing each document, and the bytes of the outputs/ files it includes. Writes them to
+    build-profile.json next to the doctrees, usually in _build, and logs the documents that take
+    the most time and memory. Tracing memory slows the whole build down, so only relative times
+    are meaningful. Documents written by parallel processes (-j) have no write times."""
+
+    def __init__(self, top):
+        self.top = top
+        self.started = time.perf_counter()
+        self.read_phase = None
+        self.writes = {}
+        self.page_context = None
+
+    def connect(self, app):
+        import tracemalloc
+
+        from sphinx.environment import BuildEnvironment
+
+        tracemalloc.start()
+        self.tracemalloc = tracemalloc
+        # Resolving and writing documents emit no event when they start, so time the calls.
+        resolve = getattr(
+            BuildEnvironment,
+            "untimed_get_and_resolve_doctree",
+            BuildEnvironment.get_and_resolve_doctree,
+        )
+        BuildEnvironment.untimed_get_and_resolve_doctree = resolve
+
+        @functools.wraps(resolve)
+        def timed_resolve(env, docname, *args, **kwargs):
+            start = self.reset()
+            doctree = resolve(env, docname, *args, **kwargs)
+            self.writes.setdefault(docname, {}).update(self.measure(start, "resolve"))
+            return doctree
+
+        BuildEnvironment.get_and_resolve_doctree = timed_resolve
+        app.connect("builder-inited", self.wrap_write_doc)
+        app.connect("env-before-read-docs", self.env_before_read_docs)
+        app.connect("source-read", self.source_read)
+        app.connect("doctree-read", self.doctree_read)
+        app.connect("env-merge-info", self.env_merge_info)
+        app.connect("env-updated", self.env_updated)
+        app.connect("html-page-context", self.html_page_context)
+        app.connect("build-finished", self.build_finished)
+
+    def reset(self):
+        self.tracemalloc.reset_peak()
+        return time.perf_counter()
+
+    def measure(self, start, phase):
+        return {
+            phase: time.perf_counter() - start,
+            f"{phase}_peak": self.tracemalloc.get_traced_memory()[1],
+        }
+
+    def wrap_write_doc(self, app):
+        write_doc = app.builder.write_doc
+
+        @functools.wraps(write_doc)
+        def timed_write_doc(docname, doctree, *args, **kwargs):
+            start = self.reset()
+            self.page_context = None
+            write_doc(docname, doctree, *args, **kwargs)
+            times = self.measure(start, "write")
+            if self.page_context is not None:
+                times["translate"] = self.page_context - start
+                times["render"] = times["write"] - times["translate"]
+            self.writes.setdefault(docname, {}).update(times)
+
+        app.builder.write_doc = timed_write_doc
+
+    def env_before_read_docs(self, app, env, docnames):
+        self.read_phase = time.perf_counter()
+        env.build_profile = {}
+
+    def source_read(self, app, docname, source):
+        # Since Sphinx 7.2, source-read is also emitted for included files.
+        if docname in app.env.found_docs and docname not in app.env.build_profile:
+            app.env.build_profile[docname] = {"started": self.reset()}
+
+    def doctree_read(self, app, doctree):
+        env = app.env
+        profile = env.build_profile.get(env.docname)
+        if profile is None:
+            return
+        profile.update(self.measure(profile.pop("started"), "read"))
+        outputs = os.path.join(os.path.realpath(app.srcdir), "outputs", "")
+        profile["output_bytes"] = sum(
+            os.path.getsize(dep)
+            for dep in env.dependencies.get(env.docname, ())
+            if os.path.realpath(dep).startswith(outputs) and os.path.isfile(dep)
+        )
+
+    def env_merge_info(self, app, env, docnames, other):
+        env.build_profile.update(
+            (docname, other.build_profile[docname])
+            for docname in docnames
+            if docname in other.build_profile
+        )
+
+    def env_updated(self, app, env):
+        if self.read_phase is not None:
+            self.read_phase = time.perf_counter() - self.read_phase
+
+    def html_page_context(self, app, pagename, templatename, context, doctree):
+        self.page_context = time.perf_counter()
+
+    def build_finished(self, app, exception):
+        if exception is not None:
+            return
+        documents = {}
+        for docname, times in getattr(app.env, "build_profile", {}).items():
+            documents[docname] = dict(times)
+        for docname, times in self.writes.items():
+            documents.setdefault(docname, {}).update(times)
+        for times in documents.values():
+            times["total"] = sum(times.get(phase, 0.0) for phase in ("read", "resolve", "write"))
+            times["peak"] = max(v for k, v in times.items() if k.endswith("_peak"))
+        profile = {
+            "total": time.perf_counter() - self.started,
+            "read": self.read_phase,
+            "peak": self.tracemalloc.get_traced_memory()[1],
+            "parallel": app.parallel,
+            "documents": documents,
+        }
+        path = os.path.join(os.path.dirname(app.doctreedir), "build-profile.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+        from sphinx.util import logging as sphinx_logging
+
+        logger = sphinx_logging.getLogger(__name__)
+        logger.info(f"build profile written to {path}, total {profile['total']:.1f}s")
+        header = (
+            f"{'document':<36}{'read':>8}{'resolve':>9}{'write':>8}{'peak':>10}{'outputs':>10}"
+        )
+        for title, key in (("slowest", "total"), ("most memory", "peak")):
+            logger.info(f"{title} documents:\n{header}")
+            top = sorted(documents.items(), key=lambda item: item[1][key], reverse=True)
+            for docname, times in top[: self.top]:
+                logger.info(
+                    f"{docname:<36}{times.get('read', 0):>7.2f}s{times.get('resolve', 0):>8.2f}s"
+                    f"{times.get('write', 0):>7.2f}s{times['peak'] / 2**20:>8.1f}MB"
+                    f"{times.get('output_bytes', 0) / 2**10:>8.0f}KB"
+                )
 
-from spack.spec_parser import SpecTokens
 
+# Enable todo items
+todo_include_todos = True
 
-class SpecLexer(RegexLexer):
+# SpecLexer uses the regexes of Spack's spec parser, snapshotted in bin/spec_tokens.py so that
+# loading the configuration does not import Spack.
+try:
+    import spec_tokens
+    from spec_tokens import SpecTokens
+except ImportError as e:
+    from sphinx.errors import ConfigError
+
+    raise ConfigError(
+        "bin/spec_tokens.py is missing, run bin/update_spec_tokens.py in a checkout with the "
+        "_spack_root submodule and commit it"
+    ) from e
+
+
+def check_spec_tokens(app):
+    """Warn if the snapshot of the spec tokens differs from the Spack in _spack_root. Spack is
+    only imported if its spec parser changed since the snapshot was taken."""
+    spack_lib = os.path.join(app.confdir, "_spack_root", "lib", "spack")
+    try:
+        with open(os.path.join(spack_lib, "spack", "spec_parser.py"), "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() == spec_tokens.SPEC_PARSER_SHA256:
+                return
+    except OSError:
+        return
+    sys.path.insert(0, spack_lib)
+    from spack.spec_parser import SpecTokens as LiveSpecTokens
+
+    live = [(token.name, token.regex) for token in LiveSpecTokens]
+    if live != [(token.name, token.regex) for token in SpecTokens]:
+        from sphinx.util import logging as sphinx_logging
+
+        sphinx_logging.getLogger(__name__).warning(
+            "bin/spec_tokens.py is out of date with _spack_root, run bin/update_spec_tokens.py"
+        )
+
+
+#: Spack subcommands that take a spec string, which SpecLexer highlights
+SPEC_SUBCOMMANDS = frozenset(
+    (
+        "install",
+        "uninstall",
+        "spec",
+        "load",
+        "unload",
+        "find",
+        "info",
+        "list",
+        "versions",
+        "providers",
+        "mark",
+        "diff",
+        "add",
+        "develop",
+    )
+)
+
+#: A word of a command line and the blanks before it
+COMMAND_WORD = re.compile(r"[^\S\n]+(\S+)")
+#: Flags between a subcommand and its spec string
+SUBCOMMAND_FLAGS = re.compile(r"(?: +-\S+)* *")
+
+
+def spack_command_end(text, pos):
+    r"""Return where ``[-e ENV | -C DIR | --flag]... SUBCOMMAND [--flag]...`` ends, after ``spack``
+    at ``pos`` in ``text``, if SUBCOMMAND takes a spec string, or None if it does not.
+
+    This accepts the same commands as the regular expression
+    ``spack(?:\s+(?:-[eC]\s+\S+|--?\S+))*\s+(?:install|...)(?: +(?:--?\S+)?)*``, which backtracks
+    exponentially in the number of flags on lines without a known subcommand. Here every word is
+    read once, by at most two parser states: expecting a flag or the subcommand, and expecting
+    the argument of ``-e`` or ``-C``. The states are ordered like the alternatives of the regular
+    expression, so that an ambiguous line such as ``spack -e install find x`` matches the same."""
+    # Parser states in order of priority: whether the next word is the argument of -e or -C.
+    states = [False]
+    end = None
+    while states:
+        match = COMMAND_WORD.match(text, pos)
+        if match is None:
+            break
+        word, pos = match.group(1), match.end()
+        next_states = []
+        for expects_argument in states:
+            if expects_argument:
+                next_states.append(False)
+            elif word.startswith("-") and len(word) > 1:
+                if word in ("-e", "-C"):
+                    next_states.append(True)
+                next_states.append(False)
+            elif word in SPEC_SUBCOMMANDS:
+                # Lower priority states are dropped, higher priority ones may still match later.
+                end = SUBCOMMAND_FLAGS.match(text, pos).end()
+                break
+        states = list(dict.fromkeys(next_states))
+    return end
+
+
+def spack_command(lexer, match, ctx):
+    """Lex a command line starting with ``spack``, and highlight the spec string of subcommands
+    that take one."""
+    end = spack_command_end(ctx.text, match.end())
+    if end is None:
+        end = match.end()
+        ctx.stack.append("command_rest")
+    else:
+        ctx.stack.append("spec")
+    yield match.start(), Text, ctx.text[match.start() : end]
+    ctx.pos = end
+
+
+class SpecLexer(ExtendedRegexLexer):
     """A custom lexer for Spack spec strings and spack commands."""
 
     name = "Spack spec"
@@ -77,11 +1284,7 @@ class SpecLexer(RegexLexer):
         ],
         "command": [
             # A spack install command is followed by a spec string, which we highlight.
-            (
-                r"spack(?:\s+(?:-[eC]\s+\S+|--?\S+))*\s+(?:install|uninstall|spec|load|unload|find|info|list|versions|providers|mark|diff|add|develop)(?: +(?:--?\S+)?)*",
-                Text,
-                "spec",
-            ),
+            (r"spack", spack_command),
             # Comment
             (r"\s+#.*?\n", Comment.Single, "command_output"),
             # Escaped newline should leave us in this mode
@@ -89,6 +1292,11 @@ class SpecLexer(RegexLexer):
             # Otherwise, it's the end of the command
             (r".*?\n", Text, "command_output"),
         ],
+        # The rest of a spack command without a spec string
+        "command_rest": [
+            (r".*?\\\n", Text, "#pop"),
+            (r".*?\n", Text, ("#pop", "command_output")),
+        ],
         "command_output": [
             (r"^\$\s+", Generic.Prompt, "#pop"),  # new command
             (r"#.*?\n", Comment.Single),  # comments
@@ -140,6 +1348,48 @@ class PatchedPythonDomain(PythonDomain):
 def setup(sphinx):
     sphinx.add_domain(PatchedPythonDomain, override=True)
     sphinx.add_lexer("spec", SpecLexer)
+    check_spec_tokens(sphinx)
+    cache_root = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "spack-tutorial"
+    )
+    sphinx.add_config_value("highlight_cache_dir", os.path.join(cache_root, "highlight"), "")
+    sphinx.add_config_value("highlight_cache_size", 20000, "")
+    sphinx.add_config_value("graphviz_cache_dir", os.path.join(cache_root, "graphviz"), "")
+    sphinx.add_config_value("graphviz_cache_size", 1000, "")
+    sphinx.add_config_value("git_dates_cache_dir", os.path.join(cache_root, "git"), "")
+    sphinx.add_config_value("git_dates_cache_size", 100, "")
+    sphinx.add_config_value("image_cache_dir", os.path.join(cache_root, "images"), "")
+    sphinx.add_config_value("image_cache_size", 1000, "")
+    sphinx.add_config_value("fingerprint_static_path", [], "html")
+    sphinx.connect("builder-inited", setup_highlight_cache)
+    sphinx.connect("build-finished", prune_highlight_cache)
+    sphinx.connect("builder-inited", setup_graphviz_cache)
+    sphinx.connect("build-finished", prune_graphviz_cache)
+    sphinx.connect("builder-inited", setup_git_dates_cache)
+    sphinx.connect("build-finished", prune_git_dates_cache)
+    sphinx.connect("builder-inited", setup_image_cache)
+    sphinx.connect("build-finished", prune_image_cache)
+    sphinx.connect("builder-inited", init_dependency_hashes)
+    sphinx.connect("doctree-read", record_dependency_hashes)
+    sphinx.connect("env-purge-doc", purge_dependency_hashes)
+    sphinx.connect("env-merge-info", merge_dependency_hashes)
+    sphinx.connect("env-get-outdated", skip_unchanged_docs)
+    sphinx.connect("config-inited", fingerprint_static_files)
+    sphinx.connect("builder-inited", write_fingerprinted_files)
+    sphinx.connect("builder-inited", init_image_bytes)
+    sphinx.connect("doctree-read", plan_image_variants)
+    sphinx.connect("env-purge-doc", purge_image_bytes)
+    sphinx.connect("env-merge-info", merge_image_bytes)
+    sphinx.connect("build-finished", report_image_bytes)
+    # before sphinx_last_updated_by_git, which runs at the default priority of 500
+    sphinx.connect("env-updated", fill_git_last_updated, priority=400)
+    if os.environ.get(PROFILE_ENV, "0") not in ("", "0"):
+        top = os.environ[PROFILE_ENV]
+        BuildProfile(int(top) if top.isdigit() and top != "1" else PROFILE_TOP).connect(sphinx)
+    # The domain only overrides cross-reference resolution, the highlight, graphviz and image
+    # caches are safe to share between processes, and the dependency hashes and image bytes of
+    # pages read in parallel are merged.
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
 
 
 # -- General configuration -----------------------------------------------------
@@ -262,7 +1512,8 @@ html_theme_options = {
 # The name of an image file (within the static path) to use as favicon of the
 # docs.  This file should be a Windows icon file (.ico) being 16x16 or 32x32
 # pixels large.
-html_favicon = "_spack_root/share/spack/logo/favicon.ico"
+if os.path.exists("_spack_root/share/spack/logo/favicon.ico"):
+    html_favicon = "_spack_root/share/spack/logo/favicon.ico"
 
 # Add any paths that contain custom static files (such as style sheets) here,
 # relative to this directory. They are copied after the builtin static files,
@@ -273,6 +1524,16 @@ html_static_path = ["_static"]
 html_css_files = [
     "css/custom.css",
 ]
+
+# Files of html_static_path to minify and rename with a hash of their content. References to them
+# in html_css_files, html_theme_options, and the templates, which look them up in static_files,
+# are rewritten to the new names.
+fingerprint_static_path = [
+    "css/custom.css",
+    "js/versions.js",
+    "images/spack-logo-text.svg",
+    "images/spack-logo-white-text.svg",
+]
 html_context = {}
 
 if os.environ.get("READTHEDOCS", "") == "True":